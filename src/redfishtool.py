@@ -8,28 +8,104 @@
 # conditions stipulated in the agreement/contract under which the
 # program(s) have been supplied.
 ####################################################################
+import atexit
+import cProfile
+import fcntl
+import hashlib
+import numbers
+import os
+import Queue
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
 import time
 import urllib2
+from bisect import bisect_right
 from collections import namedtuple
+from optparse import OptionParser
 from subprocess import PIPE, Popen, STDOUT
+from thread import get_ident
+from xml.etree import ElementTree
+from xml.parsers.expat import ExpatError
 
 import netaddr
-from simplejson import loads
+from simplejson import dumps, loads
+
+LITP_VAPP_POD = 'https://10.42.34.79/'
+STATE_DIR = '/var/lib/redfishtool.cloud'
+NODE_MAP_FILE = '/etc/redfishtool.cloud/node_map.json'
+PROBE_FILE = '/etc/redfishtool.cloud/probes.json'
+WWW_HTML = '/var/www/html/'
+GATEWAY_HOSTNAME_TTL = 3600
+SPP_POD_TTL = 3600
+ENDPOINTS_FILE = '/etc/redfishtool.cloud/endpoints.json'
+ENDPOINTS = {'gateway_hostname': ['https://atvpcspp12.athtem.eei.ericsson.se'
+                                  '/Vms/gateway_hostname'],
+             'spp_pod': ['https://ci-portal.seli.wh.rnd.internal.'
+                         'ericsson.com/getSpp/?gateway={0}']}
+SYSTEM_PATH = '/redfish/v1/Systems/1'
+PXE_REINSTALL_ACTION = 'Oem/RedfishCloud.PxeReinstall'
+POWERON_BOOT_WAIT = 180
+# SPP has no documented state endpoint, so the VM state is only read from
+# SPP when REDFISH_CLOUD_VM_STATE_API names one, e.g.
+# 'Vms/<state_api>/vm_name:{0}.xml'. It must answer with an XML document
+# holding a power_status element (on/off) and, optionally, a boot_device
+# element (net/hd). Without it, the state is what this tool last set.
+# Likewise, vApp snapshots are only taken on ENM vApps when
+# REDFISH_CLOUD_VAPP_STATE_API names a paged endpoint, formatted with the
+# gateway, the page number (from 1) and the page size, e.g.
+# 'Vms/<vapp_api>/gateway:{0}/page:{1}/limit:{2}.xml'. Each page must list
+# vm elements holding a name and the state elements above, and an empty
+# page ends the listing.
+VM_STATE_API = None
+VAPP_STATE_API = None
+SPP_NAME_TAGS = ('name',)
+SPP_POWER_TAGS = ('power_status',)
+SPP_POWER_STATES = {'on': 'On', 'poweredon': 'On',
+                    'off': 'Off', 'poweredoff': 'Off'}
+SPP_BOOT_TAGS = ('boot_device',)
+SPP_BOOT_TARGETS = {'net': 'Pxe', 'hd': 'Hdd'}
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LOG_LEVELS = {'DEBUG': DEBUG, 'INFO': INFO, 'WARNING': WARNING,
+              'ERROR': ERROR}
 
 
 def log_times(execute_time, function_name):
-    logtime = 'FunctionExec: {0:.2f}s: {1}'.format(execute_time, function_name)
-    syslog(logtime)
+    syslog('FunctionExec: {0:.2f}s: {1}', execute_time, function_name)
+
+
+class _FunctionCall(object):
+    """
+    Describes a decorated function call, only when the log message is
+    actually written.
+    """
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+
+    def __str__(self):
+        return '{0}({1}) '.format(self.function.func_name,
+                                  ','.join(str(self.args[1:])))
+
+
+class _Joined(object):
+    def __init__(self, items):
+        self.items = items
+
+    def __str__(self):
+        return ' '.join(self.items)
 
 
 def time_function():
     def real_decorator(function):
         def wrapper(*args, **kwargs):
             start_time = time.time()
-            fnction = '{0}({1}) '.format(function.func_name,
-                                         ','.join(str(args[1:])))
+            fnction = _FunctionCall(function, args)
             try:
-                syslog('Entering function {0}'.format(fnction))
+                syslog('Entering function {0}', fnction, level=DEBUG)
                 return function(*args, **kwargs)
             finally:
                 log_times(time.time() - start_time, fnction)
@@ -39,30 +115,486 @@ def time_function():
     return real_decorator
 
 
-# pylint: disable=C0325, W0621
-def syslog(message):
-    _m = 'redfish.cloud : {0}'.format(message)
+# pylint: disable=C0325
+class LogPipeline(object):
+    """
+    Buffered log writer. Messages below the level are discarded before being
+    formatted, the others are queued with their format arguments and written
+    by a background thread to syslog, or to a file when a path is given.
+    When the queue is full the message is dropped and counted rather than
+    blocking the caller; the number of dropped messages is logged once the
+    writer catches up.
+    A forked process doesn't inherit the writer thread, so it gets a writer,
+    queue and lock of its own on its first message.
+    """
+
+    def __init__(self, level=INFO, path=None, maxsize=1000):
+        self.level = level
+        self.path = path
+        self.dropped = 0
+        self.__maxsize = maxsize
+        self.__pid = os.getpid()
+        self.__queue = Queue.Queue(maxsize)
+        self.__lock = threading.Lock()
+        self.__writer = None
+
+    def log(self, level, message, args):
+        if level < self.level:
+            return
+        if self.__pid != os.getpid():
+            self.__pid = os.getpid()
+            self.__queue = Queue.Queue(self.__maxsize)
+            self.__lock = threading.Lock()
+            self.__writer = None
+        try:
+            self.__queue.put_nowait((level, message, args))
+        except Queue.Full:
+            self.dropped += 1
+        if self.__writer is None:
+            lock = self.__lock
+            lock.acquire()
+            try:
+                if self.__writer is None:
+                    self.__writer = threading.Thread(target=self._run)
+                    self.__writer.setDaemon(True)
+                    self.__writer.start()
+            finally:
+                lock.release()
+
+    def flush(self):
+        """
+        Write whatever is queued from the calling thread.
+        """
+        while True:
+            try:
+                entry = self.__queue.get_nowait()
+            except Queue.Empty:
+                return
+            self._write_entry(*entry)
+
+    def _run(self):
+        while True:
+            self._write_entry(*self.__queue.get())
+
+    def _write_entry(self, level, message, args):
+        """
+        Write a queued message. A message that can't be formatted is written
+        unformatted, and a message that can't be written at all is lost,
+        rather than stopping the writer.
+        """
+        try:
+            self._write(level, message, args)
+        except Exception:  # pylint: disable=W0703
+            try:
+                self._write(level, message, None)
+            except Exception:  # pylint: disable=W0703
+                pass
+
+    def _write(self, level, message, args):
+        if args:
+            message = message.format(*args)
+        lock = self.__lock
+        lock.acquire()
+        try:
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                self._emit(WARNING, '{0} log messages dropped'.format(dropped))
+            self._emit(level, message)
+        finally:
+            lock.release()
+
+    def _emit(self, level, message):
+        _m = 'redfish.cloud : {0}'.format(message)
+        if self.path:
+            try:
+                with open(self.path, 'a') as _f:
+                    _f.write('{0} {1}\n'.format(
+                        time.strftime('%Y-%m-%d %H:%M:%S'), _m))
+                return
+            except IOError:
+                pass
+        if _syslog is None:
+            print(_m)
+        else:
+            _syslog.syslog(_SYSLOG_PRIORITIES[level], _m)
+
+
+try:
+    import syslog as _syslog
+
+    _SYSLOG_PRIORITIES = {DEBUG: _syslog.LOG_DEBUG, INFO: _syslog.LOG_INFO,
+                          WARNING: _syslog.LOG_WARNING,
+                          ERROR: _syslog.LOG_ERR}
+except ImportError:
+    _syslog = None
+
+LOG = LogPipeline(
+    LOG_LEVELS.get(os.environ.get('REDFISH_CLOUD_LOG_LEVEL', 'INFO'), INFO),
+    os.environ.get('REDFISH_CLOUD_LOG_FILE'))
+atexit.register(LOG.flush)
+
+
+def syslog(message, *args, **kwargs):
+    """
+    Log a message through the LOG pipeline. When args are given, message is
+    a format string that is only formatted if the message is written.
+
+    :param level: One of DEBUG, INFO (the default), WARNING or ERROR.
+    """
+    LOG.log(kwargs.get('level', INFO), message, args)
+
+
+class OperationProfiler(object):
+    """
+    Opt-in profiling of whole operations, enabled with REDFISH_CLOUD_PROFILE=1
+    or enable(). Each profiled operation writes to the profile directory a
+    cProfile stats dump (.prof) of the calling thread and collapsed stacks
+    (.folded, one "thread;frame;frame count" line per stack, as taken by
+    flamegraph.pl) sampled every interval seconds from a background thread.
+    The samples cover the calling thread and every thread started during
+    the operation, such as the ones _run_concurrently runs the VMs in.
+    Only the newest max_files of the profiles written by the tool are kept.
+    When disabled, a profiled operation costs one attribute check.
+    """
+
+    DEFAULT_MAX_FILES = 50
+    FILE_PATTERN = re.compile(r'^\d+\.\d{6}-\d+-.+\.(prof|folded)$')
+
+    def __init__(self):
+        self.enabled = os.environ.get('REDFISH_CLOUD_PROFILE') == '1'
+        self.directory = os.environ.get('REDFISH_CLOUD_PROFILE_DIR')
+        max_files = os.environ.get('REDFISH_CLOUD_PROFILE_MAX_FILES')
+        try:
+            self.max_files = int(max_files or
+                                 OperationProfiler.DEFAULT_MAX_FILES)
+        except ValueError:
+            syslog('Invalid REDFISH_CLOUD_PROFILE_MAX_FILES {0}, keeping '
+                   '{1} profiles'.format(max_files,
+                                         OperationProfiler.DEFAULT_MAX_FILES),
+                   level=WARNING)
+            self.max_files = OperationProfiler.DEFAULT_MAX_FILES
+        self.interval = 0.005
+        self.__local = threading.local()
+
+    def enable(self, directory=None):
+        self.enabled = True
+        if directory:
+            self.directory = directory
+
+    def disable(self):
+        self.enabled = False
+
+    def active(self):
+        return getattr(self.__local, 'active', False)
+
+    def run(self, name, function, *args, **kwargs):
+        directory = self.directory or state_file('profiles')
+        self.__local.active = True
+        stacks = {}
+        sampling = threading.Event()
+        ignored = set(sys._current_frames())  # pylint: disable=W0212
+        ignored.discard(get_ident())
+        sampler = threading.Thread(target=self._sample, args=(
+            ignored, stacks, sampling))
+        sampler.setDaemon(True)
+        profile = cProfile.Profile()
+        sampler.start()
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            sampling.set()
+            sampler.join()
+            self.__local.active = False
+            self._save(directory, name, profile, stacks)
+
+    def _sample(self, ignored, stacks, sampling):
+        """
+        :param ignored: The idents of the threads that were already running
+         besides the calling one, they aren't part of the operation.
+        """
+        ignored = ignored | set([get_ident()])
+        while not sampling.isSet():
+            names = dict([(thread.ident, thread.name)
+                          for thread in threading.enumerate()])
+            frames = sys._current_frames()  # pylint: disable=W0212
+            for ident, frame in frames.items():
+                if ident in ignored:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{0} ({1}:{2})'.format(
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, 'Thread {0}'.format(ident)))
+                key = ';'.join(reversed(stack))
+                stacks[key] = stacks.get(key, 0) + 1
+            sampling.wait(self.interval)
+
+    def _save(self, directory, name, profile, stacks):
+        base = os.path.join(directory, '{0:.6f}-{1}-{2}'.format(
+            time.time(), os.getpid(), name))
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            profile.dump_stats(base + '.prof')
+            with open(base + '.folded', 'w') as _f:
+                for stack, count in sorted(stacks.items()):
+                    _f.write('{0} {1}\n'.format(stack, count))
+        except (IOError, OSError) as error:
+            syslog('Could not save profile {0}: {1}'.format(base, error))
+            return
+        syslog('Profile of {0} saved to {1}.prof'.format(name, base))
+        self._prune(directory)
+
+    def _prune(self, directory):
+        """
+        Remove the oldest profiles beyond max_files. Only the files named
+        like the ones _save writes are counted and removed, the profile
+        directory may be shared with other files.
+        """
+        files = []
+        try:
+            entries = os.listdir(directory)
+        except OSError as error:
+            syslog('Could not list profiles in {0}: {1}'.format(directory,
+                                                                error))
+            return
+        for entry in entries:
+            path = os.path.join(directory, entry)
+            if OperationProfiler.FILE_PATTERN.match(entry) and \
+                    os.path.isfile(path):
+                try:
+                    files.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+        files.sort()
+        for _, path in files[:max(len(files) - self.max_files, 0)]:
+            try:
+                os.remove(path)
+            except OSError as error:
+                syslog('Could not remove profile {0}: {1}'.format(path,
+                                                                   error))
+
+
+PROFILER = OperationProfiler()
+
+
+def profiled(name=None):
+    """
+    Profile the decorated operation with PROFILER when it's enabled. Nested
+    profiled operations are part of the outermost one.
+
+    :param name: The operation name used in the profile file names, the
+     function name by default. Name it explicitly when decorating another
+     decorator's wrapper, such as time_function's.
+    """
+    def real_decorator(function):
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled or PROFILER.active():
+                return function(*args, **kwargs)
+            return PROFILER.run(name or function.func_name, function,
+                                *args, **kwargs)
+
+        return wrapper
+
+    return real_decorator
+
+
+def state_file(name):
+    """
+    :return: The path of a state file of the tool, REDFISH_CLOUD_STATE_DIR
+     overrides the default directory.
+    :rtype: str
+    """
+    return os.path.join(os.environ.get('REDFISH_CLOUD_STATE_DIR', STATE_DIR),
+                        name)
+
+
+def load_state(name):
+    """
+    :return: The JSON content of a state file or None if it's missing or
+     unreadable.
+    """
+    try:
+        with open(state_file(name)) as _f:
+            return loads(_f.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_state(name, data):
+    """
+    Atomically replace a state file, through a temporary file of its own so
+    concurrent writers don't truncate each other's. State is only an
+    optimisation, so a failure is logged and otherwise ignored.
+    """
+    path = state_file(name)
     try:
-        import syslog
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        handle, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix=os.path.basename(path) + '.')
+        try:
+            with os.fdopen(handle, 'w') as _f:
+                _f.write(dumps(data))
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            os.remove(tmp_path)
+            raise
+    except (IOError, OSError) as error:
+        syslog('Could not save state {0}: {1}'.format(path, error))
+
+
+_STATE_LOCK = threading.Lock()
+
+
+def update_state(name, update):
+    """
+    Read, change and save a state file as one step. The threads of this
+    process are serialised by a lock and other processes by an exclusive
+    flock on the state file's .lock companion, so no update is lost. When
+    the lock file can't be opened the update is still made, unlocked.
+
+    :param update: Called with the content of the state file, an empty dict
+     when it's missing, to change it in place.
+    """
+    path = state_file(name)
+    with _STATE_LOCK:
+        lock_file = None
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            lock_file = open(path + '.lock', 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        except (IOError, OSError) as error:
+            syslog('Could not lock state {0}: {1}'.format(path, error))
+        try:
+            data = load_state(name) or {}
+            update(data)
+            save_state(name, data)
+        finally:
+            if lock_file is not None:
+                lock_file.close()
 
-        syslog.syslog(syslog.LOG_INFO, _m)
-    except ImportError:
-        print(_m)
+
+_PROBES = {}
+_PROBE_RESULTS = {}
+_PROBE_OVERRIDES = []
+
+
+def register_probe(name, function, key=None, ttl=None):
+    """
+    Register an expensive environment check so its result is kept in
+    memory and in the probes state file.
+
+    :param name: The probe name, REDFISH_CLOUD_<NAME> or the PROBE_FILE entry
+     of the same name override the probe.
+    :param function: Computes the probe result.
+    :param key: A cheap function, the result is reused while it returns the
+     same value.
+    :param ttl: The number of seconds the result is reused for, forever when
+     None.
+    """
+    _PROBES[name] = (function, key, ttl)
+
+
+def reset_probes():
+    """
+    Forget the in-memory probe results, the next probe will check the state
+    file again.
+    """
+    _PROBE_RESULTS.clear()
+    del _PROBE_OVERRIDES[:]
+
+
+def forget_probe(name):
+    """
+    Drop the result of a probe from memory and from the state file, so the
+    next probe computes it again.
+    """
+    _PROBE_RESULTS.pop(name, None)
+    update_state('probes.json', lambda results: results.pop(name, None))
+
+
+def _probe_override(name):
+    env_value = os.environ.get('REDFISH_CLOUD_{0}'.format(name.upper()))
+    if env_value is not None:
+        try:
+            return True, loads(env_value)
+        except ValueError:
+            return True, env_value
+    if not _PROBE_OVERRIDES:
+        try:
+            with open(os.environ.get('REDFISH_CLOUD_PROBE_FILE',
+                                     PROBE_FILE)) as _f:
+                _PROBE_OVERRIDES.append(loads(_f.read()))
+        except (IOError, OSError, ValueError):
+            _PROBE_OVERRIDES.append({})
+    if name in _PROBE_OVERRIDES[0]:
+        return True, _PROBE_OVERRIDES[0][name]
+    return False, None
+
+
+def probe(name, refresh=False):
+    """
+    :return: The result of a registered probe, computed only when there's no
+     override and no valid cached result or when refresh is requested.
+    """
+    overridden, value = _probe_override(name)
+    if overridden:
+        return value
+    function, key_function, ttl = _PROBES[name]
+    key = key_function() if key_function else None
+    now = time.time()
+    if not refresh:
+        result = _PROBE_RESULTS.get(name)
+        if result is None:
+            result = (load_state('probes.json') or {}).get(name)
+        if result and result['key'] == key and \
+                (ttl is None or now - result['time'] < ttl):
+            _PROBE_RESULTS[name] = result
+            return result['value']
+    value = function()
+    syslog('Probe {0}: {1}'.format(name, value))
+    _PROBE_RESULTS[name] = {'key': key, 'value': value, 'time': now}
+    update_state('probes.json',
+                 lambda results: results.update({name: _PROBE_RESULTS[name]}))
+    return value
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _detect_enm_vapp():
+    try:
+        for entry in os.listdir(WWW_HTML):
+            path = os.path.join(WWW_HTML, entry)
+            if 'ENM' in entry or \
+                    (os.path.islink(path) and 'ENM' in os.readlink(path)):
+                return True
+    except OSError:
+        pass
+    return False
+
+
+register_probe('enm_vapp', _detect_enm_vapp, key=lambda: _mtime(WWW_HTML))
 
 
 def is_enm_vapp():
     """
     A check to determine if we are using ENM Vapp.
     Otherwise, it will be considered LITP Vapp.
+    The result is kept until the content of /var/www/html/ changes,
+    REDFISH_CLOUD_ENM_VAPP=true|false overrides it.
     """
-    try:
-        output = exec_process(['ls', '-lrt', '/var/www/html/'])
-        if 'ENM' in output:
-            return True
-        else:
-            return False
-    except IOError:
-        return False
+    return probe('enm_vapp')
 
 
 def curl(url):
@@ -70,23 +602,189 @@ def curl(url):
         return exec_process(['/usr/bin/curl', '--insecure', '-s', url])
     except IOError as ioe:
         if ioe.args[0] == 6:
-            syslog('DNS error using hostname, updating nameserver ..')
-            with open('/etc/resolv.conf', 'a') as _f:
-                _f.write('nameserver 192.168.0.1\n')
+            _add_nameserver()
             return exec_process(['/usr/bin/curl', '--insecure', '-s', url])
         raise
 
 
+def _add_nameserver():
+    syslog('DNS error using hostname, updating nameserver ..')
+    with open('/etc/resolv.conf', 'a') as _f:
+        _f.write('nameserver 192.168.0.1\n')
+
+
+class EndpointSelector(object):
+    """
+    Latency bookkeeping for a set of equivalent endpoints: an EWMA of the
+    response time per URL to pick the fastest one first, and the last
+    response times to derive the p95 after which a request is hedged to the
+    next endpoint. Failures count as FAILURE_PENALTY seconds.
+    The statistics are kept in the endpoints state file.
+    """
+
+    FAILURE_PENALTY = 30.0
+    DEFAULT_HEDGE_DELAY = 2.0
+    MIN_SAMPLES = 5
+
+    def __init__(self, name, urls, alpha=0.3, window=20):
+        self.name = name
+        self.urls = urls
+        self.alpha = alpha
+        self.window = window
+        self.__stats = (load_state('endpoints.json') or {}).get(name, {})
+
+    def order(self):
+        """
+        :return: The URLs, fastest first. URLs without statistics come first
+         so they get measured.
+        :rtype: list
+        """
+        def ewma(url):
+            return self.__stats.get(url, {}).get('ewma', 0.0)
+
+        return sorted(self.urls, key=ewma)
+
+    def hedge_delay(self, url):
+        samples = sorted(self.__stats.get(url, {}).get('samples', []))
+        if len(samples) < EndpointSelector.MIN_SAMPLES:
+            return EndpointSelector.DEFAULT_HEDGE_DELAY
+        return samples[int(0.95 * (len(samples) - 1))]
+
+    def record(self, url, seconds, success=True):
+        """
+        Add a response time to the statistics, on top of the ones other
+        processes saved since this selector was created.
+        """
+        if not success:
+            seconds = EndpointSelector.FAILURE_PENALTY
+
+        def add_sample(endpoints):
+            self.__stats = endpoints.get(self.name, self.__stats)
+            stats = self.__stats.setdefault(url, {'samples': []})
+            if 'ewma' in stats:
+                stats['ewma'] = self.alpha * seconds + \
+                    (1 - self.alpha) * stats['ewma']
+            else:
+                stats['ewma'] = seconds
+            stats['samples'] = (stats['samples'] + [seconds])[-self.window:]
+            endpoints[self.name] = self.__stats
+
+        update_state('endpoints.json', add_sample)
+
+
+_SELECTORS = {}
+
+
+def get_endpoint_selector(name):
+    """
+    :return: The selector of the endpoints configured for name, in
+     REDFISH_CLOUD_<NAME>_URLS (comma separated), ENDPOINTS_FILE or
+     ENDPOINTS.
+    :rtype: EndpointSelector
+    """
+    if name not in _SELECTORS:
+        urls = os.environ.get('REDFISH_CLOUD_{0}_URLS'.format(name.upper()))
+        if urls:
+            urls = urls.split(',')
+        else:
+            try:
+                with open(ENDPOINTS_FILE) as _f:
+                    urls = loads(_f.read()).get(name)
+            except (IOError, OSError, ValueError):
+                urls = None
+        _SELECTORS[name] = EndpointSelector(name, urls or ENDPOINTS[name])
+    return _SELECTORS[name]
+
+
+def hedged_curl(name, *args):
+    """
+    Query one of the endpoints of name, URLs being formatted with args.
+    The fastest endpoint is queried first; if it hasn't answered within its
+    p95 response time, or failed, the same query goes to the next fastest
+    one. The first successful answer wins and the other query is killed;
+    all that's known of the killed query is that it took longer than it
+    ran, so it's recorded as at least its endpoint's p95. Like curl, a DNS
+    failure (curl exit code 6) adds a nameserver and retries the endpoint.
+
+    :raises IOError: If no endpoint answered successfully.
+    """
+    selector = get_endpoint_selector(name)
+    urls = selector.order()
+    if len(urls) == 1:
+        start_time = time.time()
+        try:
+            output = curl(urls[0].format(*args))
+        except IOError:
+            selector.record(urls[0], 0, success=False)
+            raise
+        selector.record(urls[0], time.time() - start_time)
+        return output
+
+    running = {}
+    error = None
+    hedge_at = time.time() + selector.hedge_delay(urls[0])
+    candidates = urls[:2]
+    dns_retried = []
+    try:
+        while candidates or running:
+            if candidates and (not running or time.time() >= hedge_at):
+                url = candidates.pop(0)
+                command = ['/usr/bin/curl', '--insecure', '-s',
+                           url.format(*args)]
+                syslog('{0}', _Joined(command), level=DEBUG)
+                running[url] = (Popen(command, stdout=PIPE, stderr=STDOUT),
+                                time.time())
+            for url, (process, start_time) in running.items():
+                if process.poll() is None:
+                    continue
+                del running[url]
+                output = process.communicate()[0]
+                if process.returncode == 0:
+                    selector.record(url, time.time() - start_time)
+                    return output
+                if process.returncode == 6 and url not in dns_retried:
+                    if not dns_retried:
+                        _add_nameserver()
+                    dns_retried.append(url)
+                    candidates.insert(0, url)
+                    hedge_at = time.time() + selector.hedge_delay(url)
+                    continue
+                selector.record(url, 0, success=False)
+                error = IOError(process.returncode, output)
+                hedge_at = time.time()
+            time.sleep(0.01)
+    finally:
+        for url, (process, start_time) in running.items():
+            syslog('Cancelling request to {0}'.format(url))
+            process.kill()
+            process.wait()
+            selector.record(url, max(time.time() - start_time,
+                                     selector.hedge_delay(url)))
+    raise error
+
+
+def _lookup_gateway_hostname():
+    gateway_hostname = hedged_curl('gateway_hostname')
+    if not gateway_hostname:
+        raise ValueError('Failed to get the gateway hostname.')
+    return gateway_hostname
+
+
+register_probe('gateway_hostname', _lookup_gateway_hostname,
+               ttl=GATEWAY_HOSTNAME_TTL)
+
+
+def get_gateway_hostname():
+    return probe('gateway_hostname')
+
+
 @time_function()
 def get_spp_pod(retry_wait=10):
-    gateway_hostname = curl('https://atvpcspp12.athtem.eei.ericsson.se'
-                            '/Vms/gateway_hostname')
+    gateway_hostname = get_gateway_hostname()
     attempts = 0
     while attempts < 4:
         try:
-            pod_address = curl('https://ci-portal.seli.wh.rnd.internal.'
-                               'ericsson.com/getSpp/?gateway={0}'
-                               .format(gateway_hostname))
+            pod_address = hedged_curl('spp_pod', gateway_hostname)
             syslog('get_spp_pod result: {0}'.format(pod_address))
             if pod_address in ['', 'Gateway supplied'
                                    ' does not exist in database']:
@@ -101,8 +799,16 @@ def get_spp_pod(retry_wait=10):
             time.sleep(retry_wait)
 
 
+def _lookup_spp_pod():
+    return get_spp_pod()
+
+
+register_probe('spp_pod', _lookup_spp_pod, key=get_gateway_hostname,
+               ttl=SPP_POD_TTL)
+
+
 def exec_process(command, ignore_error=False):
-    syslog(' '.join(command))
+    syslog('{0}', _Joined(command), level=DEBUG)
     process = Popen(command, stdout=PIPE, stderr=STDOUT)
     stdout = process.communicate()[0]
     if process.returncode != 0 and not ignore_error:
@@ -133,6 +839,7 @@ class LitpModelObject(object):
             self.__state = json_data['state']
         else:
             self.__state = 'N/A'
+        self.__determinable = json_data.get('applied_properties_determinable')
         self.__path = LitpModelObject.get_path_from_url(
             json_data['_links']['self']['href'])
         self.__children = {}
@@ -172,6 +879,26 @@ class LitpModelObject(object):
     def get_children(self):
         return self.__children.values()
 
+    def set_child(self, child):
+        self.__children[child.get_oid()] = child
+
+    def remove_child(self, oid):
+        self.__children.pop(oid, None)
+
+    def fingerprint(self, depth):
+        """
+        A cheap summary of the item and of its descendants down to depth
+        levels below it: type, state, applied properties marker and
+        properties. It changes whenever the subtree is edited in the model.
+        """
+        children = ()
+        if depth > 0:
+            children = tuple(sorted([child.fingerprint(depth - 1)
+                                     for child in self.get_children()]))
+        return (self.__path, self.__item_type, self.__state,
+                self.__determinable, tuple(sorted(self.__properties.items())),
+                children)
+
     def __str__(self):
         return self.get_path()
 
@@ -193,17 +920,181 @@ class LitpWrapper(object):
                                   model_path, '--json'])
         return LitpModelObject.to_object(json_data)
 
-    def find(self, start_path, item_type, depth=0):
+    def show(self, start_path, depth=0):
         command = ['/usr/bin/litp', 'show', '-p', start_path, '-r', '--json']
         if depth > 0:
             command.extend(['-n', str(depth)])
         json_data = exec_process(command)
-        root_object = LitpModelObject.to_object(json_data)
-        return self._find(root_object, item_type)
+        return LitpModelObject.to_object(json_data)
+
+    def find(self, start_path, item_type, depth=0):
+        return self._find(self.show(start_path, depth), item_type)
+
+
+class LitpModelCache(object):
+    """
+    The /deployments tree and the hostmap derived from it, kept between
+    lookups and refreshed incrementally. The hostmap and the node
+    fingerprints are also kept in a state file, so a new process starts with
+    an incremental refresh too; the nodes that changed are then mapped
+    without being spliced into a tree.
+    A refresh lists the model only down to the bmc references
+    (/deployments/<d>/clusters/<c>/nodes/<n>/system/bmc) and compares a
+    fingerprint of each node subtree with the previous one. Only the nodes
+    that changed are fetched again and spliced into the tree, and only their
+    hostmap entries are updated. The listing still covers every node, down
+    to its bmc: LITP leaves an item's parents untouched when the item is
+    updated and sets it back to Applied once the plan ran, so the state of
+    a node or of its system doesn't tell that its bmc ipaddress changed.
+    Only the bmc properties themselves do.
+    """
+
+    LISTING_DEPTH = 7
+    NODE_DEPTH = 2
+
+    def __init__(self):
+        self.__wlitp = LitpWrapper()
+        self.reset()
+
+    def reset(self):
+        self.__root = None
+        self.__index = {}
+        self.__fingerprints = {}
+        self.__node_ilos = {}
+        self.hostmap = {}
+
+    def refresh(self, full=False):
+        """
+        :raises ValueError: If an iLO address is linked to more than one
+         node.
+        """
+        if not full and not self.__fingerprints:
+            self._load()
+        try:
+            if full or not self.__fingerprints:
+                changed = self._full_refresh()
+            else:
+                changed = self._incremental_refresh()
+        except ValueError:
+            self.reset()
+            raise
+        if changed:
+            save_state('litp_model.json',
+                       {'fingerprints': self.__fingerprints,
+                        'node_ilos': self.__node_ilos,
+                        'hostmap': self.hostmap})
+        return self.hostmap
+
+    def _load(self):
+        state = load_state('litp_model.json')
+        if state:
+            self.__fingerprints = state['fingerprints']
+            self.__node_ilos = state['node_ilos']
+            self.hostmap = state['hostmap']
+
+    @staticmethod
+    def _fingerprint(node):
+        return hashlib.md5(dumps(node.fingerprint(
+            LitpModelCache.NODE_DEPTH))).hexdigest()
+
+    def _full_refresh(self):
+        self.reset()
+        self.__root = self.__wlitp.show('/deployments')
+        self._index(self.__root)
+        for node in self.__wlitp._find(self.__root, 'node'):
+            self.__fingerprints[node.get_path()] = \
+                LitpModelCache._fingerprint(node)
+            self._map_node(node)
+        return True
+
+    def _incremental_refresh(self):
+        listing = self.__wlitp.show('/deployments',
+                                    LitpModelCache.LISTING_DEPTH)
+        fingerprints = {}
+        for node in self.__wlitp._find(listing, 'node'):
+            fingerprints[node.get_path()] = \
+                LitpModelCache._fingerprint(node)
+        removed = [path for path in self.__fingerprints
+                   if path not in fingerprints]
+        for path in removed:
+            syslog('Model node {0} removed'.format(path))
+            self._unmap_node(path)
+            parent = self.__index.get(path.rsplit('/', 1)[0])
+            if parent is not None:
+                parent.remove_child(path.rsplit('/', 1)[1])
+            self._unindex(path)
+        changed = [path for path, fingerprint in fingerprints.items()
+                   if self.__fingerprints.get(path) != fingerprint]
+        for path in changed:
+            if self.__root is not None and \
+                    path.rsplit('/', 1)[0] not in self.__index:
+                syslog('Model node {0} is in a new subtree, reloading '
+                       'the model'.format(path))
+                return self._full_refresh()
+        for path in changed:
+            self._unmap_node(path)
+        for path in changed:
+            syslog('Model node {0} changed, refreshing it'.format(path))
+            node = self.__wlitp.show(path)
+            if self.__root is not None:
+                self._unindex(path)
+                self.__index[path.rsplit('/', 1)[0]].set_child(node)
+                self._index(node)
+            self._map_node(node)
+        self.__fingerprints = fingerprints
+        return bool(removed or changed)
+
+    def _index(self, lobject):
+        self.__index[lobject.get_path()] = lobject
+        for child in lobject.get_children():
+            self._index(child)
+
+    def _unindex(self, path):
+        for indexed in self.__index.keys():
+            if indexed == path or indexed.startswith(path + '/'):
+                del self.__index[indexed]
+
+    def _map_node(self, node):
+        hostname = node.get_property('hostname')
+        link = self.__wlitp._find(node, 'reference-to-bmc')
+        if link:
+            link = link[0]
+            syslog('Getting iLO address for {0}'.format(link.get_path()))
+            ilo = link.get_property('ipaddress')
+            if ilo in self.hostmap:
+                msg = 'iLO address {0} is linked to more than' \
+                      ' one node -> {1}, {2}'.format(ilo, self.hostmap[ilo],
+                                                     hostname)
+                syslog(msg)
+                raise ValueError(msg)
+            else:
+                self.hostmap[ilo] = {'hostname': hostname,
+                                     'path': node.get_path()}
+                self.__node_ilos[node.get_path()] = ilo
+
+    def _unmap_node(self, path):
+        ilo = self.__node_ilos.pop(path, None)
+        if ilo is not None:
+            del self.hostmap[ilo]
+
+
+MODEL_CACHE = LitpModelCache()
+
+
+def get_hostmap():
+    """
+    Walk the model for nodes with a reference-to-bmc and map the bmc
+    ipaddress to the node. The model is kept in MODEL_CACHE and only the
+    nodes changed since the previous call are fetched again.
+
+    :return: The node hostname and model path per iLO address
+    :rtype: dict
+    """
+    return dict(MODEL_CACHE.refresh())
 
 
 @time_function()
-def get_vm_name(ilo_address):
+def get_vm_name(ilo_address, hostmap=None):
     """
     Map an iLO address to a VM name.
     This will search the model for item types of reference-to-bmc (these
@@ -213,27 +1104,14 @@ def get_vm_name(ilo_address):
     :param ilo_address: The iLO address. Any address will do as long as it's
      unique to the node.
     :type ilo_address: str
+    :param hostmap: A hostmap already built by get_hostmap, the model is
+     walked when not given.
+    :type hostmap: dict
     :return: The hostname of node that contains the bmc entry
     :rtype: str
     """
-    wlitp = LitpWrapper()
-    hostmap = {}
-    nodes = wlitp.find('/deployments', 'node')
-    for node in nodes:
-        hostname = node.get_property('hostname')
-        link = wlitp.find(node.get_path(), 'reference-to-bmc', depth=2)
-        if link:
-            link = link[0]
-            syslog('Getting iLO address for {0}'.format(link.get_path()))
-            ilo = link.get_property('ipaddress')
-            if ilo in hostmap:
-                msg = 'iLO address {0} is linked to more than' \
-                      ' one node -> {1}, {2}'.format(ilo_address, hostmap[ilo],
-                                                     hostname)
-                syslog(msg)
-                raise ValueError(msg)
-            else:
-                hostmap[ilo] = {'hostname': hostname, 'path': node.get_path()}
+    if hostmap is None:
+        hostmap = get_hostmap()
     if ilo_address in hostmap:
         mapped_node = hostmap[ilo_address]['hostname']
         syslog('Found mapping from {0} to '
@@ -247,6 +1125,356 @@ def get_vm_name(ilo_address):
         raise ValueError(msg)
 
 
+def _parse_spp_state(xml_data):
+    """
+    Extract the power state and boot device of a VM from an SPP XML
+    response.
+
+    :param xml_data: The body returned by the SPP state API.
+    :type xml_data: str
+    :return: A dict with the Redfish PowerState and BootSourceOverrideTarget
+     that could be found in the response.
+    :rtype: dict
+    """
+    try:
+        root = ElementTree.fromstring(xml_data)
+    except (SyntaxError, ExpatError, TypeError):
+        return {}
+    return _spp_element_state(root)
+
+
+def _spp_element_state(root):
+    state = {}
+    for element in root.getiterator():
+        tag = element.tag.lower()
+        value = (element.text or '').strip().lower().replace('_', '') \
+            .replace(' ', '')
+        if tag in SPP_POWER_TAGS and value in SPP_POWER_STATES:
+            state.setdefault('PowerState', SPP_POWER_STATES[value])
+        elif tag in SPP_BOOT_TAGS and value in SPP_BOOT_TARGETS:
+            state.setdefault('BootSourceOverrideTarget',
+                             SPP_BOOT_TARGETS[value])
+    return state
+
+
+class VmStateCache(object):
+    """
+    Per-VM cache of the Redfish visible state (PowerState and
+    BootSourceOverrideTarget). Each property is timestamped on its own so an
+    action updating one property doesn't make a stale value of another one
+    look fresh.
+    """
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.__entries = {}
+        self.__lock = threading.Lock()
+
+    def get(self, vmname):
+        """
+        :return: The properties of the VM that haven't expired yet.
+        :rtype: dict
+        """
+        now = time.time()
+        state = {}
+        self.__lock.acquire()
+        try:
+            for prop, (value, stamp) in \
+                    self.__entries.get(vmname, {}).items():
+                if now - stamp < self.ttl:
+                    state[prop] = value
+        finally:
+            self.__lock.release()
+        return state
+
+    def update(self, vmname, **state):
+        now = time.time()
+        self.__lock.acquire()
+        try:
+            entry = self.__entries.setdefault(vmname, {})
+            for prop, value in state.items():
+                entry[prop] = (value, now)
+        finally:
+            self.__lock.release()
+
+    def invalidate(self, vmname=None):
+        self.__lock.acquire()
+        try:
+            if vmname is None:
+                self.__entries.clear()
+            else:
+                self.__entries.pop(vmname, None)
+        finally:
+            self.__lock.release()
+
+
+STATE_CACHE = VmStateCache()
+
+
+def read_url(url):
+    """
+    GET a URL and return its status code and body. The body holds the
+    error reason if the request failed.
+    """
+    req = urllib2.Request(url)
+    try:
+        resp = urllib2.urlopen(req)
+        return resp.code, resp.read()
+    except urllib2.HTTPError as e:
+        return e.code, e.read()
+    except urllib2.URLError as e:
+        return 0, e.reason
+
+
+def vapp_state_api():
+    return os.environ.get('REDFISH_CLOUD_VAPP_STATE_API', VAPP_STATE_API)
+
+
+class VappSnapshot(object):
+    """
+    Power state and boot device of every VM in the gateway's vApp, fetched
+    with one paged SPP request instead of one request per VM.
+    The rows are available by VM name and, for the VMs in ilo_map, by iLO
+    address. Each snapshot also refreshes the VM state cache.
+    """
+
+    def __init__(self, pod_prefix, gateway, ilo_map=None, page_size=100,
+                 max_pages=20):
+        self.pod_prefix = pod_prefix
+        self.gateway = gateway
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.by_vm = {}
+        self.by_ilo = {}
+        self.__ilo_map = ilo_map or {}
+
+    @time_function()
+    def fetch(self):
+        """
+        Read the pages until one is empty or only lists VMs already read,
+        which also ends the listing if the server ignores the paging.
+
+        :raises IOError: If no vApp state API is configured or a page of the
+         snapshot couldn't be read.
+        """
+        api = vapp_state_api()
+        if not api:
+            raise IOError('No SPP vApp state API is configured')
+        by_vm = {}
+        for page in range(1, self.max_pages + 1):
+            url = '{0}{1}'.format(self.pod_prefix,
+                                  api.format(self.gateway, page,
+                                             self.page_size))
+            syslog('Adapted SPP Rest read: {0}'.format(url))
+            status, body = read_url(url)
+            if status != 200:
+                raise IOError(status, body)
+            rows = VappSnapshot._parse_page(body)
+            if not set(rows) - set(by_vm):
+                break
+            by_vm.update(rows)
+        else:
+            syslog('vApp {0} snapshot stopped after {1} pages, VMs on later '
+                   'pages are read one by one'.format(self.gateway,
+                                                      self.max_pages),
+                   level=WARNING)
+        by_ilo = {}
+        for ilo_address, vmname in self.__ilo_map.items():
+            if vmname in by_vm:
+                by_ilo[ilo_address] = by_vm[vmname]
+        for vmname, state in by_vm.items():
+            STATE_CACHE.update(vmname, **state)
+        self.by_vm = by_vm
+        self.by_ilo = by_ilo
+        syslog('vApp {0} snapshot: {1} VMs'.format(self.gateway, len(by_vm)))
+        return self
+
+    def get(self, key):
+        """
+        :param key: A VM name or an iLO address.
+        :return: The state of the VM or None if it's not in the snapshot.
+        :rtype: dict
+        """
+        if key in self.by_vm:
+            return self.by_vm[key]
+        return self.by_ilo.get(key)
+
+    @staticmethod
+    def _parse_page(xml_data):
+        rows = {}
+        try:
+            root = ElementTree.fromstring(xml_data)
+        except (SyntaxError, ExpatError, TypeError):
+            return rows
+        for element in root.getiterator('vm'):
+            vmname = None
+            for tag in SPP_NAME_TAGS:
+                vmname = element.findtext(tag)
+                if vmname:
+                    break
+            if vmname:
+                rows[vmname.strip()] = _spp_element_state(element)
+        return rows
+
+
+@time_function()
+def get_vapp_snapshot(pod_prefix=None, ilo_map=None):
+    """
+    Snapshot the state of every VM of the gateway's vApp.
+
+    :param pod_prefix: The SPP pod, discovered like RedfishClient does when
+     not given.
+    :param ilo_map: The VM name per iLO address, taken from the model bmc
+     references on ENM vApps when not given.
+    :rtype: VappSnapshot
+    """
+    enm_vapp = None
+    if pod_prefix is None or ilo_map is None:
+        enm_vapp = is_enm_vapp()
+    if pod_prefix is None:
+        pod_prefix = probe('spp_pod') if enm_vapp else LITP_VAPP_POD
+    if ilo_map is None:
+        ilo_map = {}
+        if enm_vapp:
+            for ilo_address, node in get_hostmap().items():
+                ilo_map[ilo_address] = node['hostname']
+    return VappSnapshot(pod_prefix, get_gateway_hostname(), ilo_map).fetch()
+
+
+class NodeMapper(object):
+    """
+    Map a LITP vApp node address to its VM name using three kinds of rules,
+    in order of precedence:
+
+    * exact: {"10.42.34.42": "ms-1"}
+    * octets: [{"subnet": "10.42.34.0/24", "names": {"42": "ms-1"}}], the
+      last octet of an address in the subnet picks the name, the most
+      specific subnet wins.
+    * ranges: [{"cidr": "10.42.35.0/25", "template": "pl-{offset}"}], the
+      template is formatted with the address ip, its last octet and its
+      offset in the range.
+
+    The rules are compiled into hash tables and a sorted interval index, so a
+    lookup costs a few dict lookups and one bisect whatever the number of
+    nodes.
+    """
+
+    def __init__(self, compiled):
+        self.__exact = {}
+        for address, name in compiled['exact']:
+            self.__exact[address] = name
+        self.__octets = {}
+        for prefixlen, network, octet, name in compiled['octets']:
+            self.__octets.setdefault(prefixlen, {}) \
+                .setdefault(network, {})[octet] = name
+        self.__prefixlens = sorted(self.__octets.keys(), reverse=True)
+        self.__ranges = compiled['ranges']
+        self.__starts = [first for first, _, _ in self.__ranges]
+
+    @staticmethod
+    def compile(rules):
+        """
+        Parse the rules into the lists NodeMapper is built from. The compiled
+        form only holds JSON types so it can be kept in a state file.
+
+        :raises ValueError: If an address is invalid or ranges overlap.
+        """
+        try:
+            exact = [[int(netaddr.IPAddress(address)), name]
+                     for address, name in rules.get('exact', {}).items()]
+            octets = []
+            for rule in rules.get('octets', []):
+                subnet = netaddr.IPNetwork(rule['subnet'])
+                for octet, name in rule['names'].items():
+                    octets.append([subnet.prefixlen, subnet.first,
+                                   int(octet), name])
+            ranges = []
+            for rule in rules.get('ranges', []):
+                cidr = netaddr.IPNetwork(rule['cidr'])
+                ranges.append([cidr.first, cidr.last, rule['template']])
+        except netaddr.core.AddrFormatError as ex:
+            raise ValueError(ex)
+        ranges.sort()
+        for previous, current in zip(ranges, ranges[1:]):
+            if current[0] <= previous[1]:
+                raise ValueError('Node map ranges {0} and {1} overlap'.format(
+                    previous[2], current[2]))
+        return {'exact': exact, 'octets': octets, 'ranges': ranges}
+
+    @staticmethod
+    def load(path=None):
+        """
+        Load the node map from a JSON rules file (REDFISH_CLOUD_NODE_MAP or
+        NODE_MAP_FILE), defaulting to the RedfishClient.ip_name last octet
+        rules for any subnet.
+        The compiled rules are cached in memory and in a state file, both
+        keyed on the rules file modification time and size.
+        """
+        if path is None:
+            path = os.environ.get('REDFISH_CLOUD_NODE_MAP', NODE_MAP_FILE)
+        try:
+            stat = os.stat(path)
+            key = [path, stat.st_mtime, stat.st_size]
+        except OSError:
+            key = None
+        if _NODE_MAPPER and _NODE_MAPPER[0] == key:
+            return _NODE_MAPPER[1]
+        if key is None:
+            names = {}
+            for octet, name in RedfishClient.ip_name.items():
+                names[str(octet)] = name
+            compiled = NodeMapper.compile(
+                {'octets': [{'subnet': '0.0.0.0/0', 'names': names}]})
+        else:
+            cached = load_state('node_map.compiled.json')
+            if cached and cached['key'] == key:
+                compiled = cached['compiled']
+            else:
+                syslog('Compiling node map {0}'.format(path))
+                with open(path) as _f:
+                    compiled = NodeMapper.compile(loads(_f.read()))
+                save_state('node_map.compiled.json',
+                           {'key': key, 'compiled': compiled})
+        _NODE_MAPPER[:] = [key, NodeMapper(compiled)]
+        return _NODE_MAPPER[1]
+
+    def size(self):
+        """
+        :return: The number of rules.
+        :rtype: int
+        """
+        octets = 0
+        for networks in self.__octets.values():
+            for names in networks.values():
+                octets += len(names)
+        return len(self.__exact) + octets + len(self.__ranges)
+
+    def lookup(self, address):
+        """
+        :return: The VM name of the address or None if no rule matches.
+        :rtype: str
+        """
+        address = netaddr.IPAddress(address)
+        value = int(address)
+        if value in self.__exact:
+            return self.__exact[value]
+        octet = value & 0xff
+        for prefixlen in self.__prefixlens:
+            network = value & ((0xffffffff << (32 - prefixlen)) & 0xffffffff)
+            names = self.__octets[prefixlen].get(network)
+            if names and octet in names:
+                return names[octet]
+        index = bisect_right(self.__starts, value) - 1
+        if index >= 0 and value <= self.__ranges[index][1]:
+            first, _, template = self.__ranges[index]
+            return template.format(ip=str(address), octet=octet,
+                                   offset=value - first)
+        return None
+
+
+_NODE_MAPPER = []
+
+
 class RedfishClient(object):
 
     ip_name = {
@@ -268,37 +1496,100 @@ class RedfishClient(object):
     }
 
     def __init__(self, base_url, username=None, password=None,
-                 default_prefix='/redfish/v1/'):
+                 default_prefix='/redfish/v1/', pod_prefix=None, vmname=None):
         self.base_url = base_url
         self.username = username
         self.password = password
         self.default_prefix = default_prefix
-        if is_enm_vapp():
-            self.pod_prefix = get_spp_pod()
+        if pod_prefix is not None and vmname is not None:
+            self.pod_prefix = pod_prefix
+            self.vmname = vmname
+        elif is_enm_vapp():
+            self.pod_prefix = probe('spp_pod')
             self.vmname = get_vm_name(base_url)
         else:
-            self.pod_prefix = "https://10.42.34.79/"
-            try:
-                node_addr = netaddr.IPAddress(base_url)
-            except netaddr.core.AddrFormatError as ex:
-                raise ValueError(ex)
-
-            try:
-                self.vmname = self.ip_name[node_addr.words[-1]]
-            except KeyError:
-                raise ValueError("VApp node IP {0} is not valid"
-                                 .format(node_addr))
+            self.pod_prefix = LITP_VAPP_POD
+            self.vmname = RedfishClient.litp_vm_name(base_url)
 
         syslog('Cloud POD is {0}'.format(self.pod_prefix))
         syslog('Mapped iLO {0} to {1}'.format(base_url, self.vmname))
 
+    @classmethod
+    def litp_vm_name(cls, base_url):
+        try:
+            node_addr = netaddr.IPAddress(base_url)
+        except netaddr.core.AddrFormatError as ex:
+            raise ValueError(ex)
+
+        vmname = NodeMapper.load().lookup(node_addr)
+        if vmname is None:
+            raise ValueError("VApp node IP {0} is not valid"
+                             .format(node_addr))
+        return vmname
+
+    @profiled('get')
+    def get(self, path, refresh=False):
+        """
+        Read-only view of the Systems resource, served from the VM state
+        cache. The SPP state API, when configured, is only called when the
+        cache doesn't hold a fresh PowerState or when refresh is requested.
+        """
+        if not path.rstrip('/').endswith(SYSTEM_PATH):
+            return RedfishClient._create_spp_response(400,
+                                                      'ActionNotSupported')
+        state = STATE_CACHE.get(self.vmname)
+        if refresh or 'PowerState' not in state:
+            resp = self.refresh_state()
+            if resp.status != 200:
+                return resp
+            state = STATE_CACHE.get(self.vmname)
+        target = state.get('BootSourceOverrideTarget', 'None')
+        system = {'@odata.id': SYSTEM_PATH,
+                  'Id': '1',
+                  'Name': self.vmname,
+                  'PowerState': state['PowerState'],
+                  'Boot': {'BootSourceOverrideTarget': target,
+                           'BootSourceOverrideEnabled':
+                               'Once' if target == 'Pxe' else 'Disabled'}}
+        spp_response = namedtuple('spp_response', 'status dict')
+        return spp_response(status=200, dict=system)
+
+    @time_function()
+    def refresh_state(self):
+        api = os.environ.get('REDFISH_CLOUD_VM_STATE_API', VM_STATE_API)
+        if not api:
+            msg = 'The state of {0} is unknown, no SPP state API is ' \
+                  'configured'.format(self.vmname)
+            return RedfishClient._create_spp_response(503, msg)
+        apistr = api.format(self.vmname)
+        status, body = self._read_cloud_api(apistr)
+        if status != 200:
+            return RedfishClient._create_spp_response(status, body)
+        state = _parse_spp_state(body)
+        if 'PowerState' not in state:
+            msg = 'Could not read the power state of {0}'.format(self.vmname)
+            syslog(msg)
+            return RedfishClient._create_spp_response(500, msg)
+        STATE_CACHE.update(self.vmname, **state)
+        return RedfishClient._create_spp_response(200, 'State refreshed')
+
+    @profiled('patch')
     def patch(self, path, body):
         if '/redfish/v1/Systems/1/' in path and \
                 body["Boot"]["BootSourceOverrideTarget"] == "Pxe":
             return self.set_bootdev_pxe()
         return RedfishClient._create_spp_response(400, 'ActionNotSupported')
 
+    @profiled('post')
     def post(self, path, body=None):
+        if PXE_REINSTALL_ACTION in path:
+            boot_wait = (body or {}).get('BootWait', POWERON_BOOT_WAIT)
+            if isinstance(boot_wait, bool) or \
+                    not isinstance(boot_wait, numbers.Real) or \
+                    not 0 <= boot_wait < float('inf'):
+                return RedfishClient._create_spp_response(
+                    400, 'BootWait must be a non-negative number of seconds')
+            return self.pxe_reinstall(boot_wait)
         if 'ComputerSystem.Reset' in path:
             if body["ResetType"] == "ForceOff":
                 return self.set_poweroff()
@@ -314,6 +1605,12 @@ class RedfishClient(object):
 
     @time_function()
     def set_bootdev_pxe(self):
+        # A boot device reset left queued by an earlier power on would
+        # undo this before the VM is powered on.
+        self._supersede_jobs('bootdev_hd')
+        return self._set_boot_device('net')
+
+    def _set_bootdev_net(self):
         return self._set_boot_device('net')
 
     @time_function()
@@ -324,35 +1621,139 @@ class RedfishClient(object):
         apistr = "Vms/set_boot_device_api/boot_devices:{0}/vm_name:{1}.xml". \
             format(dev, str(self.vmname))
         if dev == 'hd':
-            return self._call_cloud_api(apistr, "Set Boot Device to disk")
+            return self._record_state(
+                self._call_cloud_api(apistr, "Set Boot Device to disk"),
+                BootSourceOverrideTarget=SPP_BOOT_TARGETS[dev])
 
         apistr = "{0}:{1}/vm_name:{2}.xml".format(
             'Vms/set_boot_device_api/boot_devices', 'net', str(self.vmname))
-        return self._call_cloud_api(apistr, "Set Boot Device to pxe")
+        return self._record_state(
+            self._call_cloud_api(apistr, "Set Boot Device to pxe"),
+            BootSourceOverrideTarget=SPP_BOOT_TARGETS[dev])
 
     @time_function()
     def set_poweroff(self):
         apistr = "Vms/poweroff_api/vm_name:%s.xml" % (str(self.vmname))
-        return self._call_cloud_api(apistr, "Chassis Power Control: Down/Off")
+        return self._record_state(
+            self._call_cloud_api(apistr, "Chassis Power Control: Down/Off"),
+            PowerState='Off')
 
     @time_function()
     def set_poweron(self):
-        apistr = "Vms/poweron_api/vm_name:%s.xml" % (str(self.vmname))
-        poweron_resp = self._call_cloud_api(
-            apistr, "Chassis Power Control: Up/On")
-
         # As Redfish can set boot device to pxe once, with SPP boot device
-        # needs to be manually reset after power on.
-        time.sleep(180)
-        boot_dev_resp = self.set_bootdev_hd()
+        # needs to be manually reset after power on. The reset is queued
+        # first, so a worker still runs it if this process dies during the
+        # boot wait.
+        reset = self._submit_job('bootdev_hd', POWERON_BOOT_WAIT)
+        poweron_resp = self._power_on()
+
+        time.sleep(POWERON_BOOT_WAIT)
+        boot_dev_resp = self._run_job(reset, self.set_bootdev_hd)
 
         if poweron_resp.status == 200 and boot_dev_resp.status != 200:
-            msg = 'Error setting boot device to disk: ' + \
-                  boot_dev_resp.dict["Message"]
-            return RedfishClient._create_spp_response(boot_dev_resp.status,
-                                                      msg)
+            return RedfishClient._boot_disk_error(boot_dev_resp)
         return poweron_resp
 
+    @time_function()
+    def pxe_reinstall(self, boot_wait=POWERON_BOOT_WAIT):
+        """
+        Power cycle the VM into a PXE boot: ForceOff, boot device to pxe,
+        On and, once the VM had boot_wait seconds to boot from the network,
+        boot device back to disk.
+        The boot device is only set to pxe once the VM is confirmed off, and
+        it's reset to disk if the power on fails, so a failed reinstall
+        never leaves the VM to PXE boot on its next start. Like in
+        set_poweron, the reset to disk is queued before the power on. The
+        time each step took is returned under Steps.
+        """
+        steps = []
+
+        def run_step(name, method):
+            start_time = time.time()
+            resp = method()
+            steps.append({'Step': name, 'Status': resp.status,
+                          'Seconds': round(time.time() - start_time, 2)})
+            return resp
+
+        def failed(resp):
+            return RedfishClient._create_spp_response(
+                resp.status, resp.dict["Message"], Steps=steps)
+
+        for name, method in (('ForceOff', self.set_poweroff),
+                             ('Pxe', self.set_bootdev_pxe)):
+            resp = run_step(name, method)
+            if resp.status != 200:
+                return failed(resp)
+
+        reset = self._submit_job('bootdev_hd', boot_wait)
+        poweron_resp = run_step('On', self._power_on)
+        if poweron_resp.status != 200:
+            run_step('Hdd', lambda: self._run_job(reset, self.set_bootdev_hd))
+            return failed(poweron_resp)
+
+        run_step('BootWait', lambda: RedfishClient._boot_wait(boot_wait))
+        boot_dev_resp = run_step(
+            'Hdd', lambda: self._run_job(reset, self.set_bootdev_hd))
+        if boot_dev_resp.status != 200:
+            return failed(RedfishClient._boot_disk_error(boot_dev_resp))
+        return RedfishClient._create_spp_response(
+            200, 'PXE reinstall of {0} started'.format(self.vmname),
+            Steps=steps)
+
+    def _power_on(self):
+        apistr = "Vms/poweron_api/vm_name:%s.xml" % (str(self.vmname))
+        return self._record_state(
+            self._call_cloud_api(apistr, "Chassis Power Control: Up/On"),
+            PowerState='On')
+
+    def _submit_job(self, action, delay):
+        """
+        Queue an operation on the VM, due in delay seconds, in place of the
+        pending ones of the same action.
+
+        :return: The job queue and job id, None if the job queue can't be
+         used.
+        :rtype: tuple
+        """
+        try:
+            queue = JobQueue()
+            queue.supersede(self, action)
+            return queue, queue.submit(self, action, delay)
+        except (sqlite3.Error, OSError) as error:
+            syslog('Job queue unavailable, {0} of {1} not queued: '
+                   '{2}'.format(action, self.vmname, error), level=WARNING)
+            return None
+
+    def _supersede_jobs(self, action):
+        try:
+            JobQueue().supersede(self, action)
+        except (sqlite3.Error, OSError) as error:
+            syslog('Job queue unavailable, pending {0} jobs of {1} not '
+                   'superseded: {2}'.format(action, self.vmname, error),
+                   level=WARNING)
+
+    @staticmethod
+    def _run_job(job, method):
+        """
+        Run a job queued by _submit_job now, or call method instead if it
+        couldn't be queued or run.
+        """
+        if job is not None:
+            queue, job_id = job
+            try:
+                job = queue.run_now(job_id)
+            except sqlite3.Error as error:
+                syslog('Job {0} could not be run: {1}'.format(job_id, error),
+                       level=WARNING)
+                job = None
+        if job is None:
+            return method()
+        if job['state'] == 'superseded':
+            # The later operation owns the boot device now.
+            return RedfishClient._create_spp_response(200, job['message'])
+        return RedfishClient._create_spp_response(job['status'],
+                                                  job['message'])
+
     @time_function()
     def _call_cloud_api(self, apistr, msg):
         url = '{0}{1}'.format(self.pod_prefix, apistr)
@@ -364,10 +1765,608 @@ class RedfishClient(object):
         except urllib2.HTTPError as e:
             return RedfishClient._create_spp_response(e.code, e.read())
         except urllib2.URLError as e:
+            # The vApp may have moved to another pod.
+            forget_probe('spp_pod')
             return RedfishClient._create_spp_response(0, e.reason)
 
+    def _record_state(self, resp, **state):
+        """
+        Keep the state cache in line with the actions this tool performed.
+        A failed action leaves the VM in an unknown state, so the cached
+        entry is dropped and the next read goes to the SPP API.
+        """
+        if resp.status == 200:
+            STATE_CACHE.update(self.vmname, **state)
+        else:
+            STATE_CACHE.invalidate(self.vmname)
+        return resp
+
+    @time_function()
+    def _read_cloud_api(self, apistr):
+        url = '{0}{1}'.format(self.pod_prefix, apistr)
+        syslog('Adapted SPP Rest read: {0}'.format(url))
+        return read_url(url)
+
+    @staticmethod
+    def _boot_wait(seconds):
+        time.sleep(seconds)
+        return RedfishClient._create_spp_response(200, 'Boot wait')
+
+    @staticmethod
+    def _boot_disk_error(boot_dev_resp):
+        msg = 'Error setting boot device to disk: ' + \
+              boot_dev_resp.dict["Message"]
+        return RedfishClient._create_spp_response(boot_dev_resp.status, msg)
+
     @staticmethod
-    def _create_spp_response(status, msg):
+    def _create_spp_response(status, msg, **extra):
         spp_response = namedtuple('spp_response', 'status dict')
         msg_dict = {"Message": msg}
+        msg_dict.update(extra)
         return spp_response(status=status, dict=msg_dict)
+
+
+def resolve_clients(ilo_addresses, username=None, password=None):
+    """
+    Build a RedfishClient per iLO address, discovering the vApp type and
+    SPP pod and walking the model only once for all of them.
+
+    :return: The client per iLO address.
+    :rtype: dict
+    """
+    clients = {}
+    if is_enm_vapp():
+        pod_prefix = probe('spp_pod')
+        hostmap = get_hostmap()
+        for ilo_address in ilo_addresses:
+            clients[ilo_address] = RedfishClient(
+                ilo_address, username, password, pod_prefix=pod_prefix,
+                vmname=get_vm_name(ilo_address, hostmap))
+    else:
+        for ilo_address in ilo_addresses:
+            clients[ilo_address] = RedfishClient(
+                ilo_address, username, password, pod_prefix=LITP_VAPP_POD,
+                vmname=RedfishClient.litp_vm_name(ilo_address))
+    return clients
+
+
+def _run_concurrently(clients, method):
+    """
+    Call method on every client, each in its own thread.
+
+    :param clients: The RedfishClient per iLO address.
+    :type clients: dict
+    :return: The response per iLO address, an exception raised by method is
+     returned as a 500 response.
+    :rtype: dict
+    """
+    results = {}
+    threads = []
+    for ilo_address, client in clients.items():
+        def run(ilo_address=ilo_address, client=client):
+            try:
+                results[ilo_address] = method(client)
+            except Exception as error:  # pylint: disable=W0703
+                msg = 'Operation on {0} failed: {1}'.format(client.vmname,
+                                                             error)
+                syslog(msg, level=ERROR)
+                results[ilo_address] = RedfishClient._create_spp_response(
+                    500, msg)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+@profiled('pxe_reinstall')
+@time_function()
+def pxe_reinstall(ilo_addresses, username=None, password=None,
+                  boot_wait=POWERON_BOOT_WAIT):
+    """
+    Run RedfishClient.pxe_reinstall on many nodes at once, so their boot
+    waits overlap.
+
+    :return: The pxe_reinstall response per iLO address.
+    :rtype: dict
+    """
+    return _run_concurrently(
+        resolve_clients(ilo_addresses, username, password),
+        lambda client: client.pxe_reinstall(boot_wait))
+
+
+RECONCILE_ACTIONS = ('ForceOff', 'Pxe', 'Hdd', 'On')
+
+
+def plan_reconcile(current, desired):
+    """
+    Compute the minimum set of actions that takes a VM from its current
+    state to the desired one.
+    Powering on resets the boot device to disk, so a desired Pxe target is
+    set before the power on and a desired Hdd target needs no extra action
+    when the VM gets powered on. A Pxe target is therefore consumed by the
+    power on it precedes, like a Redfish BootSourceOverrideEnabled=Once.
+
+    :param current: The current Redfish state (PowerState and
+     BootSourceOverrideTarget).
+    :type current: dict
+    :param desired: The desired Redfish state, any property left out is
+     not reconciled.
+    :type desired: dict
+    :return: The actions to run, in RECONCILE_ACTIONS order.
+    :rtype: list
+    """
+    actions = []
+    power = desired.get('PowerState')
+    target = desired.get('BootSourceOverrideTarget')
+    power_on = power == 'On' and current.get('PowerState') != 'On'
+    if power == 'Off' and current.get('PowerState') != 'Off':
+        actions.append('ForceOff')
+    if target == 'Pxe' and \
+            (power_on or current.get('BootSourceOverrideTarget') != 'Pxe'):
+        actions.append('Pxe')
+    elif target == 'Hdd' and not power_on and \
+            current.get('BootSourceOverrideTarget') != 'Hdd':
+        actions.append('Hdd')
+    if power_on:
+        actions.append('On')
+    return actions
+
+
+@profiled('reconcile')
+@time_function()
+def reconcile(desired, username=None, password=None):
+    """
+    Bring a set of VMs to their desired power and boot device state,
+    running only the actions plan_reconcile finds necessary.
+    The current state of every VM is read once up front, with a single
+    vApp snapshot when there is more than one VM of an ENM vApp and a vApp
+    state API is configured; all the power offs
+    are then run first, the boot device changes next and the power ons
+    last. The VMs of a phase are handled concurrently, so their power on
+    boot waits overlap. A VM whose action fails gets no further actions.
+    A VM whose state can't be read is planned from an unknown state, which
+    runs every action its desired state asks for.
+
+    :param desired: The desired Redfish state per iLO address.
+    :type desired: dict
+    :return: The (action, response) pairs run per iLO address.
+    :rtype: dict
+    """
+    plans = {}
+    results = {}
+    clients = resolve_clients(desired.keys(), username, password)
+    pods = set([client.pod_prefix for client in clients.values()])
+    if len(clients) > 1 and len(pods) == 1 and vapp_state_api() and \
+            is_enm_vapp():
+        ilo_map = {}
+        for ilo_address, client in clients.items():
+            ilo_map[ilo_address] = client.vmname
+        try:
+            get_vapp_snapshot(pods.pop(), ilo_map)
+        except (IOError, ValueError) as ioe:
+            syslog('vApp snapshot failed, reading VMs one by one: '
+                   '{0}'.format(ioe))
+    for ilo_address, state in desired.items():
+        client = clients[ilo_address]
+        results[ilo_address] = []
+        current = client.get(SYSTEM_PATH)
+        if current.status == 200:
+            current_state = {
+                'PowerState': current.dict['PowerState'],
+                'BootSourceOverrideTarget':
+                    current.dict['Boot']['BootSourceOverrideTarget']}
+        else:
+            syslog('Reconcile of {0} from an unknown state: {1}'.format(
+                client.vmname, current.dict['Message']))
+            current_state = {}
+        plans[ilo_address] = plan_reconcile(current_state, state)
+        syslog('Reconcile plan for {0}: {1}'.format(client.vmname,
+                                                    plans[ilo_address]))
+    methods = {'ForceOff': RedfishClient.set_poweroff,
+               'Pxe': RedfishClient.set_bootdev_pxe,
+               'Hdd': RedfishClient.set_bootdev_hd,
+               'On': RedfishClient.set_poweron}
+    for action in RECONCILE_ACTIONS:
+        selected = {}
+        for ilo_address, plan in plans.items():
+            if action in plan:
+                selected[ilo_address] = clients[ilo_address]
+        for ilo_address, resp in _run_concurrently(
+                selected, methods[action]).items():
+            results[ilo_address].append((action, resp))
+            if resp.status != 200:
+                del plans[ilo_address]
+    return results
+
+
+class JobQueue(object):
+    """
+    Persistent queue of power and boot device operations, kept in an SQLite
+    database so an operation outlives the process that asked for it.
+    Each operation is a list of steps (JOB_STEPS) and the job records the
+    step it's at: a poweron whose caller dies during the boot wait still
+    gets its boot device reset to disk by the next worker.
+    Workers run jobs of different VMs concurrently, the jobs of one VM run
+    one at a time in submission order. A job belongs to the process that
+    queued it, or ran its last step, until it's done.
+    RedfishClient.set_poweron and pxe_reinstall queue the boot device reset
+    that follows their boot wait and run it themselves once it's due. If
+    they die first, the job is resumed the next time the queue is opened:
+    the due steps of the jobs whose process no longer exists are run then,
+    by any power operation or by 'redfishtool.cloud worker', which also
+    runs every other pending job and exits.
+    """
+
+    JOB_STEPS = {'poweroff': ('ForceOff',),
+                 'poweron': ('On', 'Hdd'),
+                 'bootdev_pxe': ('Pxe',),
+                 'bootdev_hd': ('Hdd',),
+                 'pxe_reinstall': ('ForceOff', 'Pxe', 'On', 'Hdd')}
+    FINAL_STATES = ('done', 'failed', 'superseded')
+    STEP_METHODS = {'ForceOff': 'set_poweroff',
+                    'Pxe': '_set_bootdev_net',
+                    'On': '_power_on',
+                    'Hdd': 'set_bootdev_hd'}
+
+    def __init__(self, path=None, boot_wait=POWERON_BOOT_WAIT,
+                 poll_interval=1):
+        self.path = path or state_file('jobs.db')
+        self.boot_wait = boot_wait
+        self.poll_interval = poll_interval
+        self.__workers = []
+        self.__stopping = threading.Event()
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        conn = self._connect()
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'ilo TEXT, pod_prefix TEXT, vmname TEXT, '
+                         'action TEXT, step INTEGER DEFAULT 0, '
+                         'state TEXT, owner INTEGER, not_before REAL, '
+                         'created REAL, updated REAL, '
+                         'status INTEGER, message TEXT)')
+            for job in conn.execute('SELECT id, owner FROM jobs '
+                                    'WHERE state = ?', ('running',)):
+                if not JobQueue._is_alive(job['owner']):
+                    syslog('Resuming job {0}'.format(job['id']))
+                    conn.execute('UPDATE jobs SET state = ? WHERE id = ?',
+                                 ('pending', job['id']))
+            conn.commit()
+        finally:
+            conn.close()
+        self._run_orphans()
+
+    def _run_orphans(self):
+        """
+        Run the due steps of the jobs whose process died, so an interrupted
+        boot device reset doesn't wait for a worker to be run.
+        """
+        while True:
+            job_id = self._next_orphan()
+            if job_id is None or not self.run_next(job_id):
+                return
+
+    def _next_orphan(self):
+        conn = self._connect()
+        try:
+            for job in conn.execute(
+                    'SELECT id, owner FROM jobs WHERE state = ? AND '
+                    'not_before <= ? AND owner IS NOT NULL ORDER BY id',
+                    ('pending', time.time())).fetchall():
+                if not JobQueue._is_alive(job['owner']):
+                    return job['id']
+            return None
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _is_alive(pid):
+        try:
+            os.kill(pid, 0)
+            return True
+        except (OSError, TypeError):
+            return False
+
+    def submit(self, client, action, delay=0):
+        """
+        Queue an operation on the VM of a RedfishClient.
+
+        :param action: One of the JOB_STEPS operations.
+        :param delay: The number of seconds before the operation is due.
+        :return: The job id.
+        :rtype: int
+        """
+        if action not in JobQueue.JOB_STEPS:
+            raise ValueError('Unknown job action {0}'.format(action))
+        now = time.time()
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                'INSERT INTO jobs (ilo, pod_prefix, vmname, action, state, '
+                'owner, not_before, created, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (client.base_url, client.pod_prefix, client.vmname, action,
+                 'pending', os.getpid(), now + delay, now, now))
+            conn.commit()
+            syslog('Queued job {0}: {1} {2}'.format(cursor.lastrowid, action,
+                                                    client.vmname))
+            return cursor.lastrowid
+        finally:
+            conn.close()
+
+    def supersede(self, client, action):
+        """
+        Cancel the pending jobs of an action on the VM of a RedfishClient,
+        left by an earlier operation that a new one replaces.
+
+        :return: The number of jobs superseded.
+        :rtype: int
+        """
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                'UPDATE jobs SET state = ?, owner = NULL, updated = ?, '
+                'message = ? WHERE vmname = ? AND action = ? AND state = ?',
+                ('superseded', time.time(), 'Superseded by a later operation',
+                 client.vmname, action, 'pending'))
+            conn.commit()
+            if cursor.rowcount:
+                syslog('Superseded {0} pending {1} jobs of {2}'.format(
+                    cursor.rowcount, action, client.vmname))
+            return cursor.rowcount
+        finally:
+            conn.close()
+
+    def get(self, job_id):
+        """
+        :return: The job columns or None if there's no such job.
+        :rtype: dict
+        """
+        conn = self._connect()
+        try:
+            job = conn.execute('SELECT * FROM jobs WHERE id = ?',
+                               (job_id,)).fetchone()
+            if job is None:
+                return None
+            return dict(zip(job.keys(), tuple(job)))
+        finally:
+            conn.close()
+
+    def wait(self, job_id, timeout=None):
+        """
+        Wait for a job to be done, failed or superseded.
+
+        :return: The job columns or None if the timeout expired first.
+        :rtype: dict
+        """
+        start_time = time.time()
+        while True:
+            job = self.get(job_id)
+            if job is None or job['state'] in JobQueue.FINAL_STATES:
+                return job
+            if timeout is not None and time.time() - start_time > timeout:
+                return None
+            time.sleep(self.poll_interval)
+
+    def _claim(self, job_id=None):
+        now = time.time()
+        conn = self._connect()
+        conn.isolation_level = None
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            if job_id is None:
+                condition, args = 'not_before <= ?', (now,)
+            else:
+                condition = 'j.vmname = (SELECT vmname FROM jobs ' \
+                            'WHERE id = ?) AND (j.id = ? OR not_before <= ?)'
+                args = (job_id, job_id, now)
+            job = conn.execute(
+                'SELECT * FROM jobs AS j WHERE state = ? AND ' + condition +
+                ' AND NOT EXISTS (SELECT 1 FROM jobs AS o '
+                'WHERE o.vmname = j.vmname AND o.id < j.id '
+                'AND o.state IN (?, ?)) ORDER BY id LIMIT 1',
+                ('pending',) + args + ('pending', 'running')).fetchone()
+            if job is not None:
+                conn.execute('UPDATE jobs SET state = ?, owner = ?, '
+                             'updated = ? WHERE id = ?',
+                             ('running', os.getpid(), now, job['id']))
+            conn.execute('COMMIT')
+            return job
+        finally:
+            conn.close()
+
+    def run_next(self, job_id=None):
+        """
+        Run the next step of the first job that can run.
+
+        :param job_id: Only run a step of this job, even if it isn't due yet,
+         or of an earlier due job of the same VM.
+        :return: False if no job was ready.
+        :rtype: bool
+        """
+        job = self._claim(job_id)
+        if job is None:
+            return False
+        steps = JobQueue.JOB_STEPS[job['action']]
+        step = steps[job['step']]
+        client = RedfishClient(job['ilo'], pod_prefix=job['pod_prefix'],
+                               vmname=job['vmname'])
+        try:
+            resp = getattr(client, JobQueue.STEP_METHODS[step])()
+            status, message = resp.status, resp.dict["Message"]
+        except Exception as error:  # pylint: disable=W0703
+            status, message = 500, str(error)
+        now = time.time()
+        owner = None
+        if status != 200:
+            state, next_step, not_before = 'failed', job['step'], now
+        elif job['step'] + 1 < len(steps):
+            state, next_step, owner = 'pending', job['step'] + 1, os.getpid()
+            not_before = now + self.boot_wait if step == 'On' else now
+        else:
+            state, next_step, not_before = 'done', job['step'], now
+        syslog('Job {0} {1} step {2}: {3} {4}'.format(
+            job['id'], job['action'], step, status, message))
+        conn = self._connect()
+        try:
+            conn.execute('UPDATE jobs SET state = ?, step = ?, owner = ?, '
+                         'not_before = ?, updated = ?, status = ?, '
+                         'message = ? WHERE id = ?',
+                         (state, next_step, owner, not_before, now, status,
+                          message, job['id']))
+            conn.commit()
+        finally:
+            conn.close()
+        return True
+
+    def run_now(self, job_id):
+        """
+        Run a job in this process without waiting for its steps to be due,
+        or wait for the worker that is already running it.
+
+        :return: The job columns once it's done, failed or superseded.
+        :rtype: dict
+        """
+        while True:
+            job = self.get(job_id)
+            if job is None or job['state'] in JobQueue.FINAL_STATES:
+                return job
+            if not self.run_next(job_id):
+                time.sleep(self.poll_interval)
+
+    def drain(self, workers=4):
+        """
+        Run the queued jobs, waiting for the ones that aren't due yet, until
+        none is left pending.
+        """
+        self.start(workers)
+        try:
+            while self._count_pending():
+                time.sleep(self.poll_interval)
+        finally:
+            self.stop()
+
+    def _count_pending(self):
+        conn = self._connect()
+        try:
+            return conn.execute(
+                'SELECT COUNT(*) FROM jobs WHERE state = ? '
+                'OR (state = ? AND owner = ?)',
+                ('pending', 'running', os.getpid())).fetchone()[0]
+        finally:
+            conn.close()
+
+    def start(self, workers=4):
+        """
+        Start worker threads running the queued jobs until stop is called.
+        """
+        self.__stopping.clear()
+        for _ in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.setDaemon(True)
+            worker.start()
+            self.__workers.append(worker)
+
+    def stop(self):
+        self.__stopping.set()
+        for worker in self.__workers:
+            worker.join()
+        del self.__workers[:]
+
+    def _work(self):
+        while not self.__stopping.isSet():
+            try:
+                ran = self.run_next()
+            except Exception as error:  # pylint: disable=W0703
+                syslog('Job worker error: {0}'.format(error), level=ERROR)
+                ran = False
+            if not ran:
+                self.__stopping.wait(self.poll_interval)
+
+
+@profiled('warmup')
+def warmup():
+    """
+    Precompute and persist everything the first power operation would
+    otherwise look up: the vApp type, the gateway hostname and SPP pod, and
+    the iLO to VM mapping of every bmc referenced node (the LITP model on ENM
+    vApps, the node map on LITP vApps). The pod's Vms/ API is then checked
+    for reachability.
+
+    :return: One entry per stage with its Result, or Error, and the Seconds
+     it took.
+    :rtype: list
+    """
+    report = []
+
+    def stage(name, function):
+        start_time = time.time()
+        entry = {'Stage': name}
+        try:
+            entry['Result'] = function()
+        except Exception as error:  # pylint: disable=W0703
+            entry['Error'] = str(error)
+        entry['Seconds'] = round(time.time() - start_time, 2)
+        syslog('Warm-up {0}: {1}'.format(name, entry))
+        report.append(entry)
+        return entry.get('Result')
+
+    if stage('environment', lambda: probe('enm_vapp', refresh=True)):
+        stage('gateway_hostname',
+              lambda: probe('gateway_hostname', refresh=True))
+        pod_prefix = stage('spp_pod', lambda: probe('spp_pod', refresh=True))
+        stage('hostmap',
+              lambda: '{0} nodes'.format(len(MODEL_CACHE.refresh(True))))
+    else:
+        pod_prefix = LITP_VAPP_POD
+        stage('node_map',
+              lambda: '{0} rules'.format(NodeMapper.load().size()))
+    if pod_prefix:
+        stage('pod_api', lambda: _check_pod_api(pod_prefix))
+    return report
+
+
+def _check_pod_api(pod_prefix):
+    status, body = read_url('{0}Vms/'.format(pod_prefix))
+    if status == 0:
+        raise IOError(status, body)
+    return 'HTTP {0}'.format(status)
+
+
+def main(argv=None):
+    parser = OptionParser(
+        usage='%prog warmup [--profile [--profile-dir DIR]]\n'
+              '       %prog worker [--workers N]')
+    parser.add_option('--profile', action='store_true', default=False,
+                      help='profile the operation')
+    parser.add_option('--profile-dir', help='where profiles are written')
+    parser.add_option('--workers', type='int', default=4,
+                      help='number of worker threads running queued jobs')
+    options, args = parser.parse_args(argv)
+    if args not in (['warmup'], ['worker']):
+        parser.error('unknown command')
+    if options.profile:
+        PROFILER.enable(options.profile_dir)
+    if args == ['worker']:
+        JobQueue().drain(options.workers)
+        return 0
+    failed = False
+    for entry in warmup():
+        failed = failed or 'Error' in entry
+        print('{0:<18} {1:>7.2f}s  {2}'.format(
+            entry['Stage'], entry['Seconds'],
+            entry.get('Result', entry.get('Error'))))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 from collections import namedtuple
 from os.path import dirname, join, realpath
 from unittest import TestCase
@@ -15,6 +18,11 @@ SPP_POD = 'redfishtool.get_spp_pod'
 RESET = "/redfish/v1/Systems/1/Actions/ComputerSystem.Reset/"
 POWER_ON = 'https://atvcloud3/Vms/poweron_api/vm_name:cloud-svc-1.xml'
 HD_BOOT = 'https://atvcloud3/Vms/set_boot_device_api/boot_devices:hd/vm_name:cloud-svc-1.xml'
+NODES = '{"item-type-name": "collection-of-node", "id": "nodes", "_embedded": {"item": [%s]}, ' \
+        '"_links": {"self": {"href": "https://localhost:9999/litp/rest/v1/deployments/enm/clusters/services_cluster/nodes"}}}'
+VAPP_API = 'Vms/vapp/{0}/{1}/{2}.xml'
+VAPP_PAGE = '<vms><vm><name>{0}</name><power_status>{1}</power_status>' \
+            '<boot_device>hd</boot_device></vm></vms>'
 
 
 class TestEnmRedfishCloudTool(TestCase):
@@ -24,7 +32,17 @@ class TestEnmRedfishCloudTool(TestCase):
     """
 
     def setUp(self):
-        pass  # Ignore
+        redfishtool.STATE_CACHE.invalidate()
+        redfishtool.reset_probes()
+        redfishtool._SELECTORS.clear()
+        redfishtool.MODEL_CACHE.reset()
+        self.state_dir = tempfile.mkdtemp()
+        self.state_env = patch.dict(os.environ, {'REDFISH_CLOUD_STATE_DIR': self.state_dir})
+        self.state_env.start()
+
+    def tearDown(self):
+        self.state_env.stop()
+        shutil.rmtree(self.state_dir)
 
     def mock_curl(self, exec_process, gateway_host,
                   pod='https://pod.athtem.eei.ericsson.se/'):
@@ -353,6 +371,24 @@ class TestEnmRedfishCloudTool(TestCase):
         self.mock_curl_failure(exec_process, 'atvts1234')
         self.assertRaises(IOError, lambda: redfishtool.get_spp_pod(retry_wait=1))
 
+    @patch('redfishtool.exec_process')
+    @patch('redfishtool.urllib2.urlopen')
+    def test_spp_pod_probe(self, mock_urlopen, exec_process):
+        self.mock_curl(exec_process, 'atvts1234', pod=ATVCLOUD)
+        self.assertEquals(ATVCLOUD, redfishtool.probe('spp_pod'))
+
+        self.mock_curl(exec_process, 'atvts5678', pod='https://atvcloud4/')
+        self.assertEquals(ATVCLOUD, redfishtool.probe('spp_pod'))
+        redfishtool.probe('gateway_hostname', refresh=True)
+        self.assertEquals('https://atvcloud4/', redfishtool.probe('spp_pod'))
+
+        mock_urlopen.side_effect = redfishtool.urllib2.URLError('Connection refused')
+        self.adapter = RedfishClient('1.1.1.42', 'user', 'pass', REDFISH_V1,
+                                     pod_prefix='https://atvcloud4/', vmname='cloud-svc-1')
+        self.assertEquals(0, self.adapter.set_poweroff().status)
+        self.mock_curl(exec_process, 'atvts5678', pod='https://atvcloud5/')
+        self.assertEquals('https://atvcloud5/', redfishtool.probe('spp_pod'))
+
     @patch('redfishtool.exec_process')
     def test_curl(self, exec_process):
 
@@ -382,3 +418,242 @@ class TestEnmRedfishCloudTool(TestCase):
             output = redfishtool.curl(URL)
             self.assertEquals(return_string, output)
             self.assertEquals(2, exec_process.call_count)
+
+    @patch('redfishtool.is_enm_vapp')
+    @patch('redfishtool.get_gateway_hostname')
+    @patch('redfishtool.exec_process')
+    @patch('redfishtool.urllib2.Request')
+    @patch('redfishtool.urllib2.urlopen')
+    def test_get_vapp_snapshot(self, mock_urlopen, mock_request, exec_process, mock_gateway, mock_enm):
+        self.mock_find_nodes(exec_process, [('cloud-svc-1', 'cloud-svc-1', '1.1.1.42')])
+        mock_enm.return_value = True
+        mock_gateway.return_value = 'atvts1234'
+        resp = MagicMock(code=200)
+        resp.read.return_value = VAPP_PAGE.format('cloud-svc-1', 'poweredOn')
+        mock_urlopen.return_value = resp
+
+        with patch(SPP_POD) as get_spp_pod:
+            get_spp_pod.return_value = ATVCLOUD
+            with patch.dict(os.environ, {'REDFISH_CLOUD_VAPP_STATE_API': VAPP_API}):
+                snapshot = redfishtool.get_vapp_snapshot()
+
+        mock_request.assert_has_calls([call('https://atvcloud3/Vms/vapp/atvts1234/1/100.xml'),
+                                       call('https://atvcloud3/Vms/vapp/atvts1234/2/100.xml')])
+        self.assertEquals(2, mock_request.call_count)
+        expected = {'PowerState': 'On', 'BootSourceOverrideTarget': 'Hdd'}
+        self.assertEquals(expected, snapshot.get('cloud-svc-1'))
+        self.assertEquals(expected, snapshot.get('1.1.1.42'))
+        self.assertEquals(expected, redfishtool.STATE_CACHE.get('cloud-svc-1'))
+
+    @patch('redfishtool.urllib2.Request')
+    @patch('redfishtool.urllib2.urlopen')
+    def test_vapp_snapshot_pages(self, mock_urlopen, mock_request):
+        page1 = MagicMock(code=200)
+        page1.read.return_value = VAPP_PAGE.format('vm1', 'on')
+        page2 = MagicMock(code=200)
+        page2.read.return_value = '<vms/>'
+        mock_urlopen.side_effect = [page1, page2]
+
+        self.assertRaises(IOError, redfishtool.VappSnapshot(ATVCLOUD, 'atvts1234').fetch)
+        self.assertEquals(0, mock_request.call_count)
+
+        with patch.dict(os.environ, {'REDFISH_CLOUD_VAPP_STATE_API': VAPP_API}):
+            snapshot = redfishtool.VappSnapshot(ATVCLOUD, 'atvts1234', page_size=1).fetch()
+            mock_request.assert_has_calls([call('https://atvcloud3/Vms/vapp/atvts1234/1/1.xml'),
+                                           call('https://atvcloud3/Vms/vapp/atvts1234/2/1.xml')])
+            self.assertEquals(['vm1'], snapshot.by_vm.keys())
+            self.assertEquals(None, snapshot.get('vm2'))
+
+            mock_urlopen.side_effect = None
+            mock_urlopen.return_value = page1
+            snapshot = redfishtool.VappSnapshot(ATVCLOUD, 'atvts1234').fetch()
+            self.assertEquals(4, mock_request.call_count)
+            self.assertEquals(['vm1'], snapshot.by_vm.keys())
+
+            error = MagicMock(code=500)
+            error.read.return_value = 'Internal error'
+            mock_urlopen.side_effect = [error]
+            self.assertRaises(IOError, redfishtool.VappSnapshot(ATVCLOUD, 'atvts1234').fetch)
+
+    @patch('redfishtool.is_enm_vapp')
+    @patch('redfishtool.get_vapp_snapshot')
+    @patch('redfishtool.resolve_clients')
+    def test_reconcile_snapshot_error(self, mock_clients, mock_snapshot, mock_enm):
+        mock_enm.return_value = True
+        mock_clients.return_value = {
+            '1.1.1.42': RedfishClient('1.1.1.42', 'user', 'pass', pod_prefix=ATVCLOUD, vmname='vm1'),
+            '1.1.1.43': RedfishClient('1.1.1.43', 'user', 'pass', pod_prefix=ATVCLOUD, vmname='vm2')}
+        mock_snapshot.side_effect = ValueError('Failed to get the gateway hostname.')
+        redfishtool.STATE_CACHE.update('vm1', PowerState='On', BootSourceOverrideTarget='Hdd')
+        redfishtool.STATE_CACHE.update('vm2', PowerState='On', BootSourceOverrideTarget='Hdd')
+        desired = {'1.1.1.42': {'PowerState': 'On'}, '1.1.1.43': {'PowerState': 'On'}}
+
+        with patch.dict(os.environ, {'REDFISH_CLOUD_VAPP_STATE_API': VAPP_API}):
+            results = redfishtool.reconcile(desired)
+        self.assertEquals({'1.1.1.42': [], '1.1.1.43': []}, results)
+        self.assertEquals(1, mock_snapshot.call_count)
+
+    @patch('redfishtool.exec_process')
+    @patch('redfishtool.os.listdir')
+    def test_is_enm_vapp(self, mock_listdir, exec_process):
+        mock_listdir.return_value = ['ENM_iso', 'index.html']
+        self.assertTrue(redfishtool.is_enm_vapp())
+        self.assertFalse(exec_process.called)
+
+        mock_listdir.return_value = ['index.html']
+        self.assertTrue(redfishtool.is_enm_vapp())
+        self.assertEquals(1, mock_listdir.call_count)
+        self.assertFalse(redfishtool.probe('enm_vapp', refresh=True))
+
+        with patch.dict(os.environ, {'REDFISH_CLOUD_ENM_VAPP': 'true'}):
+            self.assertTrue(redfishtool.is_enm_vapp())
+
+    @patch('redfishtool.exec_process')
+    def test_get_gateway_hostname_cached(self, exec_process):
+        self.mock_curl(exec_process, 'atvts1234')
+
+        self.assertEquals('atvts1234', redfishtool.get_gateway_hostname())
+        self.assertEquals('atvts1234', redfishtool.get_gateway_hostname())
+        redfishtool.reset_probes()
+        self.assertEquals('atvts1234', redfishtool.get_gateway_hostname())
+        self.assertEquals(1, exec_process.call_count)
+
+        self.mock_curl(exec_process, '')
+        self.assertRaises(ValueError, redfishtool.probe, 'gateway_hostname', refresh=True)
+
+    @patch('redfishtool.Popen')
+    def test_hedged_curl(self, mock_popen):
+        slow = MagicMock()
+        slow.poll.return_value = None
+        fast = MagicMock(returncode=0)
+        fast.communicate.return_value = ('https://pod.athtem.eei.ericsson.se/', None)
+        mock_popen.side_effect = [slow, fast]
+        urls = 'https://portal1/getSpp/?gateway={0},https://portal2/getSpp/?gateway={0}'
+
+        with patch.dict(os.environ, {'REDFISH_CLOUD_SPP_POD_URLS': urls}):
+            with patch.object(redfishtool.EndpointSelector, 'DEFAULT_HEDGE_DELAY', 0):
+                pod = redfishtool.hedged_curl('spp_pod', 'atvts1234')
+
+        self.assertEquals('https://pod.athtem.eei.ericsson.se/', pod)
+        self.assertEquals('https://portal1/getSpp/?gateway=atvts1234', mock_popen.call_args_list[0][0][0][-1])
+        self.assertEquals('https://portal2/getSpp/?gateway=atvts1234', mock_popen.call_args_list[1][0][0][-1])
+        slow.kill.assert_called_once_with()
+
+        selector = redfishtool.get_endpoint_selector('spp_pod')
+        self.assertEquals(['https://portal2/getSpp/?gateway={0}', 'https://portal1/getSpp/?gateway={0}'],
+                          selector.order())
+
+    @patch('redfishtool._add_nameserver')
+    @patch('redfishtool.Popen')
+    def test_hedged_curl_cancelled(self, mock_popen, mock_nameserver):
+        dns_error = MagicMock(returncode=6)
+        dns_error.communicate.return_value = ('', None)
+        first = MagicMock(returncode=0)
+        first.poll.side_effect = [None, 0]
+        first.communicate.return_value = ('https://pod.athtem.eei.ericsson.se/', None)
+        hedge = MagicMock()
+        hedge.poll.return_value = None
+        mock_popen.side_effect = [dns_error, first, hedge]
+        portal1 = 'https://portal1/getSpp/?gateway={0}'
+        portal2 = 'https://portal2/getSpp/?gateway={0}'
+
+        with patch.dict(os.environ, {'REDFISH_CLOUD_SPP_POD_URLS': ','.join([portal1, portal2])}):
+            with patch.object(redfishtool.EndpointSelector, 'DEFAULT_HEDGE_DELAY', 0):
+                selector = redfishtool.get_endpoint_selector('spp_pod')
+                for _ in range(redfishtool.EndpointSelector.MIN_SAMPLES):
+                    selector.record(portal2, 0.5)
+                pod = redfishtool.hedged_curl('spp_pod', 'atvts1234')
+
+        self.assertEquals('https://pod.athtem.eei.ericsson.se/', pod)
+        mock_nameserver.assert_called_once_with()
+        self.assertEquals([portal1.format('atvts1234')] * 2 + [portal2.format('atvts1234')],
+                          [args[0][-1] for args, _ in mock_popen.call_args_list])
+        hedge.kill.assert_called_once_with()
+        stats = redfishtool.load_state('endpoints.json')['spp_pod']
+        self.assertEquals(0.5, stats[portal2]['samples'][-1])
+        self.assertEquals(1, len(stats[portal1]['samples']))
+
+    def test_endpoint_selector(self):
+        selector = redfishtool.EndpointSelector('test', ['https://a', 'https://b'])
+        self.assertEquals(redfishtool.EndpointSelector.DEFAULT_HEDGE_DELAY, selector.hedge_delay('https://a'))
+        for seconds in range(1, 21):
+            selector.record('https://a', seconds / 10.0)
+        selector.record('https://b', 0, success=False)
+        self.assertEquals(['https://a', 'https://b'], selector.order())
+        self.assertEquals(1.9, selector.hedge_delay('https://a'))
+        self.assertEquals(['https://a', 'https://b'],
+                          redfishtool.EndpointSelector('test', ['https://b', 'https://a']).order())
+
+    def test_endpoint_selector_shared(self):
+        first = redfishtool.EndpointSelector('test', ['https://a'])
+        second = redfishtool.EndpointSelector('test', ['https://a'])
+        first.record('https://a', 1.0)
+        second.record('https://a', 2.0)
+        first.record('https://a', 3.0)
+        stats = redfishtool.load_state('endpoints.json')['test']['https://a']
+        self.assertEquals([1.0, 2.0, 3.0], stats['samples'])
+        self.assertEquals(['endpoints.json', 'endpoints.json.lock'], sorted(os.listdir(self.state_dir)))
+
+    @patch('redfishtool.exec_process')
+    def test_get_hostmap_incremental(self, exec_process):
+        self.model = [('vm1', 'vm1', '1.1.1.222'), ('vm2', 'vm2', '1.1.1.223')]
+
+        def show(command):
+            if command[3] == '/deployments':
+                return NODES % ','.join([self.mock_node(*node) for node in self.model])
+            for node in self.model:
+                if command[3].endswith('/' + node[1]):
+                    return self.mock_node(*node)
+
+        exec_process.side_effect = show
+        hostmap = redfishtool.get_hostmap()
+        self.assertEquals('vm2', hostmap['1.1.1.223']['hostname'])
+        exec_process.assert_called_once_with(['/usr/bin/litp', 'show', '-p', '/deployments', '-r', '--json'])
+
+        exec_process.reset_mock()
+        self.assertEquals('vm1', redfishtool.get_vm_name('1.1.1.222'))
+        exec_process.assert_called_once_with(['/usr/bin/litp', 'show', '-p', '/deployments', '-r', '--json',
+                                              '-n', '7'])
+
+        exec_process.reset_mock()
+        self.model[1] = ('vm2', 'vm2', '1.1.1.224')
+        self.assertEquals('vm2', redfishtool.get_vm_name('1.1.1.224'))
+        self.assertRaises(ValueError, redfishtool.get_vm_name, '1.1.1.223')
+        self.assertEquals(call(['/usr/bin/litp', 'show', '-p',
+                                '/deployments/enm/clusters/services_cluster/nodes/vm2', '-r', '--json']),
+                          exec_process.call_args_list[1])
+        self.assertEquals(3, exec_process.call_count)
+
+        self.model[1] = ('vm2', 'vm2', '1.1.1.222')
+        self.assertRaises(ValueError, redfishtool.get_hostmap)
+
+    @patch('redfishtool.exec_process')
+    @patch('redfishtool.urllib2.Request')
+    @patch('redfishtool.urllib2.urlopen')
+    def test_warmup(self, mock_urlopen, mock_request, exec_process):
+        def side_effect(command):
+            if command[-1].endswith('gateway_hostname'):
+                return 'atvts1234'
+            elif command[-1].endswith('atvts1234'):
+                return ATVCLOUD
+            return self.mock_node('cloud-svc-1', 'cloud-svc-1', '1.1.1.42')
+
+        exec_process.side_effect = side_effect
+        mock_urlopen.return_value = MagicMock(code=200)
+
+        with patch.dict(os.environ, {'REDFISH_CLOUD_ENM_VAPP': 'true'}):
+            report = redfishtool.warmup()
+            self.assertEquals(['environment', 'gateway_hostname', 'spp_pod', 'hostmap', 'pod_api'],
+                              [entry['Stage'] for entry in report])
+            self.assertEquals(ATVCLOUD, report[2]['Result'])
+            self.assertEquals('1 nodes', report[3]['Result'])
+            mock_request.assert_called_once_with('https://atvcloud3/Vms/')
+
+            redfishtool.reset_probes()
+            redfishtool.MODEL_CACHE.reset()
+            exec_process.reset_mock()
+            self.adapter = RedfishClient('1.1.1.42', 'user', 'pass', REDFISH_V1)
+            self.assertEquals(ATVCLOUD, self.adapter.pod_prefix)
+            self.assertEquals('cloud-svc-1', self.adapter.vmname)
+            exec_process.assert_called_once_with(['/usr/bin/litp', 'show', '-p', '/deployments', '-r', '--json',
+                                                  '-n', '7'])
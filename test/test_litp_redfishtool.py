@@ -1,7 +1,12 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
 from collections import namedtuple
 from unittest import TestCase
 
-from mock import patch
+from mock import MagicMock, patch
 
 import redfishtool
 from redfishtool import RedfishClient
@@ -9,6 +14,7 @@ from redfishtool import RedfishClient
 # Common Constants
 REDFISH_V1 = '/redfish/v1/'
 RESET = "/redfish/v1/Systems/1/Actions/ComputerSystem.Reset/"
+SYSTEM = "/redfish/v1/Systems/1/"
 
 
 class TestLitpRedfishCloudTool(TestCase):
@@ -18,7 +24,16 @@ class TestLitpRedfishCloudTool(TestCase):
     """
 
     def setUp(self):
-        pass  # Ignore
+        redfishtool.STATE_CACHE.invalidate()
+        redfishtool.reset_probes()
+        del redfishtool._NODE_MAPPER[:]
+        self.state_dir = tempfile.mkdtemp()
+        self.state_env = patch.dict(os.environ, {'REDFISH_CLOUD_STATE_DIR': self.state_dir})
+        self.state_env.start()
+
+    def tearDown(self):
+        self.state_env.stop()
+        shutil.rmtree(self.state_dir)
 
     @patch('redfishtool.urllib2.Request')
     @patch('redfishtool.urllib2.urlopen')
@@ -189,3 +204,522 @@ class TestLitpRedfishCloudTool(TestCase):
         returned_response = self.adapter.patch("/invalid", body=body)
         self.assertEquals(400, returned_response.status)
         self.assertEquals('ActionNotSupported', returned_response.dict["Message"])
+
+    @patch('redfishtool.urllib2.Request')
+    @patch('redfishtool.urllib2.urlopen')
+    def test_get_system_cached(self, mock_urlopen, mock_request):
+        resp = MagicMock(code=200)
+        resp.read.return_value = '<vm><power_status>poweredOn</power_status></vm>'
+        mock_urlopen.return_value = resp
+
+        with patch.dict(os.environ, {'REDFISH_CLOUD_VM_STATE_API': 'Vms/state/{0}.xml'}):
+            self.adapter = RedfishClient('1.1.1.42', 'user', 'pass', REDFISH_V1)
+            returned_response = self.adapter.get(SYSTEM)
+            self.assertEquals(200, returned_response.status)
+            self.assertEquals('On', returned_response.dict['PowerState'])
+            self.assertEquals('ms-1', returned_response.dict['Name'])
+
+            self.adapter.get(SYSTEM)
+            mock_request.assert_called_once_with('https://10.42.34.79/Vms/state/ms-1.xml')
+
+            self.adapter.get(SYSTEM, refresh=True)
+            self.assertEquals(2, mock_request.call_count)
+
+    @patch('redfishtool.urllib2.Request')
+    @patch('redfishtool.urllib2.urlopen')
+    def test_get_system_state_api(self, mock_urlopen, mock_request):
+        resp = MagicMock(code=200)
+        resp.read.return_value = '<vm><status>off</status><power_status>on</power_status>' \
+                                 '<boot_device>net</boot_device></vm>'
+        mock_urlopen.return_value = resp
+
+        with patch.dict(os.environ, {'REDFISH_CLOUD_VM_STATE_API': 'Vms/state/{0}.xml'}):
+            self.adapter = RedfishClient('1.1.1.42', 'user', 'pass', REDFISH_V1)
+            returned_response = self.adapter.get(SYSTEM)
+        mock_request.assert_called_once_with('https://10.42.34.79/Vms/state/ms-1.xml')
+        self.assertEquals('On', returned_response.dict['PowerState'])
+        self.assertEquals('Pxe', returned_response.dict['Boot']['BootSourceOverrideTarget'])
+
+    @patch('redfishtool.urllib2.urlopen')
+    def test_get_system_no_state_api(self, mock_urlopen):
+        self.adapter = RedfishClient('1.1.1.42', 'user', 'pass', REDFISH_V1)
+        returned_response = self.adapter.get(SYSTEM)
+        self.assertEquals(503, returned_response.status)
+        self.assertEquals(0, mock_urlopen.call_count)
+
+    @patch('redfishtool.urllib2.Request')
+    @patch('redfishtool.urllib2.urlopen')
+    def test_get_system_after_actions(self, mock_urlopen, mock_request):
+        resp = namedtuple('resp', 'code')
+        mock_urlopen.return_value = resp(code=200)
+
+        self.adapter = RedfishClient('1.1.1.42', 'user', 'pass', REDFISH_V1)
+        self.adapter.set_poweroff()
+        self.adapter.set_bootdev_pxe()
+        returned_response = self.adapter.get(SYSTEM)
+        self.assertEquals(2, mock_request.call_count)
+        self.assertEquals('Off', returned_response.dict['PowerState'])
+        self.assertEquals('Pxe', returned_response.dict['Boot']['BootSourceOverrideTarget'])
+        self.assertEquals('Once', returned_response.dict['Boot']['BootSourceOverrideEnabled'])
+
+    @patch('redfishtool.urllib2.urlopen')
+    def test_get_system_unknown_state(self, mock_urlopen):
+        resp = MagicMock(code=200)
+        resp.read.return_value = '<vm><power_status>unknown</power_status></vm>'
+        mock_urlopen.return_value = resp
+
+        with patch.dict(os.environ, {'REDFISH_CLOUD_VM_STATE_API': 'Vms/state/{0}.xml'}):
+            self.adapter = RedfishClient('1.1.1.42', 'user', 'pass', REDFISH_V1)
+            returned_response = self.adapter.get(SYSTEM)
+        self.assertEquals(500, returned_response.status)
+
+    def test_get_bad_path(self):
+        self.adapter = RedfishClient('15.16.17.43', 'user', 'pass', REDFISH_V1)
+        returned_response = self.adapter.get("/redfish/v1/Chassis/1/")
+        self.assertEquals(400, returned_response.status)
+        self.assertEquals('ActionNotSupported', returned_response.dict["Message"])
+
+    def test_plan_reconcile(self):
+        off_pxe = {'PowerState': 'Off', 'BootSourceOverrideTarget': 'Pxe'}
+        on_hdd = {'PowerState': 'On', 'BootSourceOverrideTarget': 'Hdd'}
+        self.assertEquals([], redfishtool.plan_reconcile(on_hdd, on_hdd))
+        self.assertEquals([], redfishtool.plan_reconcile(on_hdd, {'PowerState': 'On'}))
+        self.assertEquals(['On'], redfishtool.plan_reconcile(off_pxe, on_hdd))
+        self.assertEquals(['ForceOff', 'Pxe'], redfishtool.plan_reconcile(on_hdd, off_pxe))
+        self.assertEquals(['Pxe', 'On'], redfishtool.plan_reconcile(
+            off_pxe, {'PowerState': 'On', 'BootSourceOverrideTarget': 'Pxe'}))
+        self.assertEquals(['Hdd'], redfishtool.plan_reconcile(
+            off_pxe, {'BootSourceOverrideTarget': 'Hdd'}))
+
+    @patch('redfishtool.get_gateway_hostname')
+    @patch('redfishtool.get_vapp_snapshot')
+    @patch('redfishtool.urllib2.Request')
+    @patch('redfishtool.urllib2.urlopen')
+    def test_reconcile(self, mock_urlopen, mock_request, mock_snapshot, mock_gateway):
+        resp = namedtuple('resp', 'code')
+        mock_urlopen.return_value = resp(code=200)
+        redfishtool.STATE_CACHE.update('ms-1', PowerState='On', BootSourceOverrideTarget='Hdd')
+        redfishtool.STATE_CACHE.update('sc-1', PowerState='On', BootSourceOverrideTarget='Hdd')
+        desired = {'1.1.1.42': {'PowerState': 'Off', 'BootSourceOverrideTarget': 'Pxe'},
+                   '1.1.1.43': {'PowerState': 'On'}}
+
+        results = redfishtool.reconcile(desired)
+        self.assertEquals(['ForceOff', 'Pxe'], [action for action, _ in results['1.1.1.42']])
+        self.assertEquals([], results['1.1.1.43'])
+        self.assertEquals(2, mock_request.call_count)
+
+        results = redfishtool.reconcile(desired)
+        self.assertEquals([], results['1.1.1.42'])
+        self.assertEquals(2, mock_request.call_count)
+        self.assertFalse(mock_snapshot.called)
+        self.assertFalse(mock_gateway.called)
+
+    @patch('redfishtool.get_vapp_snapshot')
+    @patch('redfishtool.urllib2.Request')
+    @patch('redfishtool.urllib2.urlopen')
+    def test_reconcile_unknown_state(self, mock_urlopen, mock_request, mock_snapshot):
+        resp = namedtuple('resp', 'code')
+        mock_urlopen.return_value = resp(code=200)
+        desired = {'1.1.1.42': {'PowerState': 'Off', 'BootSourceOverrideTarget': 'Pxe'},
+                   '1.1.1.43': {'BootSourceOverrideTarget': 'Hdd'}}
+
+        results = redfishtool.reconcile(desired)
+        self.assertEquals(['ForceOff', 'Pxe'], [action for action, _ in results['1.1.1.42']])
+        self.assertEquals(['Hdd'], [action for action, _ in results['1.1.1.43']])
+        self.assertEquals(3, mock_request.call_count)
+
+    @patch('redfishtool.get_vapp_snapshot')
+    @patch('redfishtool.RedfishClient.set_poweron')
+    def test_reconcile_concurrent_poweron(self, mock_poweron, mock_snapshot):
+        powering_on = []
+        both_started = threading.Event()
+
+        def power_on(client):
+            powering_on.append(client.vmname)
+            if len(powering_on) == 2:
+                both_started.set()
+            both_started.wait(5)
+            if client.vmname == 'sc-1':
+                raise IOError('Connection reset')
+            return RedfishClient._create_spp_response(200 if both_started.isSet() else 500, 'On')
+
+        mock_poweron.side_effect = power_on
+        redfishtool.STATE_CACHE.update('ms-1', PowerState='Off', BootSourceOverrideTarget='Hdd')
+        redfishtool.STATE_CACHE.update('sc-1', PowerState='Off', BootSourceOverrideTarget='Hdd')
+        desired = {'1.1.1.42': {'PowerState': 'On'}, '1.1.1.43': {'PowerState': 'On'}}
+
+        results = redfishtool.reconcile(desired)
+        self.assertEquals(200, results['1.1.1.42'][0][1].status)
+        self.assertEquals(500, results['1.1.1.43'][0][1].status)
+        self.assertEquals('Operation on sc-1 failed: Connection reset',
+                          results['1.1.1.43'][0][1].dict['Message'])
+
+    @patch('redfishtool.time.sleep', return_value=None)
+    @patch('redfishtool.urllib2.Request')
+    @patch('redfishtool.urllib2.urlopen')
+    def test_pxe_reinstall(self, mock_urlopen, mock_request, mock_sleep):
+        resp = namedtuple('resp', 'code')
+        mock_urlopen.return_value = resp(code=200)
+
+        results = redfishtool.pxe_reinstall(['1.1.1.42', '1.1.1.43'], boot_wait=5)
+        self.assertEquals(200, results['1.1.1.42'].status)
+        self.assertEquals(200, results['1.1.1.43'].status)
+        requested = set([args[0] for args, _ in mock_request.call_args_list])
+        expected = set()
+        for vmname in ('ms-1', 'sc-1'):
+            expected.update(['https://10.42.34.79/Vms/poweroff_api/vm_name:{0}.xml'.format(vmname),
+                             'https://10.42.34.79/Vms/set_boot_device_api/boot_devices:net/'
+                             'vm_name:{0}.xml'.format(vmname),
+                             'https://10.42.34.79/Vms/poweron_api/vm_name:{0}.xml'.format(vmname),
+                             'https://10.42.34.79/Vms/set_boot_device_api/boot_devices:hd/'
+                             'vm_name:{0}.xml'.format(vmname)])
+        self.assertEquals(expected, requested)
+        steps = [step['Step'] for step in results['1.1.1.42'].dict['Steps']]
+        self.assertEquals(['ForceOff', 'Pxe', 'On', 'BootWait', 'Hdd'], steps)
+        mock_sleep.assert_called_with(5)
+        self.assertEquals({'PowerState': 'On', 'BootSourceOverrideTarget': 'Hdd'},
+                          redfishtool.STATE_CACHE.get('sc-1'))
+
+    @patch('redfishtool.RedfishClient.pxe_reinstall')
+    def test_pxe_reinstall_exception(self, mock_method):
+        mock_method.side_effect = IOError('Connection reset')
+
+        results = redfishtool.pxe_reinstall(['1.1.1.42'])
+        self.assertEquals(500, results['1.1.1.42'].status)
+
+    @patch('redfishtool.urllib2.Request')
+    @patch('redfishtool.urllib2.urlopen')
+    def test_pxe_reinstall_poweroff_error(self, mock_urlopen, mock_request):
+        resp = namedtuple('resp', 'code')
+        mock_urlopen.return_value = resp(code=200)
+
+        self.adapter = RedfishClient('1.1.1.42', 'user', 'pass', REDFISH_V1)
+        with patch('redfishtool.RedfishClient.set_poweroff') as mock_poweroff:
+            mock_poweroff.return_value = RedfishClient._create_spp_response(404, 'Not found')
+            returned_response = self.adapter.pxe_reinstall()
+        self.assertEquals(404, returned_response.status)
+        self.assertEquals('Not found', returned_response.dict['Message'])
+        self.assertFalse(mock_request.called)
+
+    @patch('redfishtool.time.sleep', return_value=None)
+    @patch('redfishtool.urllib2.Request')
+    @patch('redfishtool.urllib2.urlopen')
+    def test_pxe_reinstall_poweron_error(self, mock_urlopen, mock_request, mock_sleep):
+        resp = namedtuple('resp', 'code')
+        mock_urlopen.side_effect = [resp(code=200), resp(code=200), resp(code=404), resp(code=200)]
+
+        self.adapter = RedfishClient('1.1.1.42', 'user', 'pass', REDFISH_V1)
+        returned_response = self.adapter.pxe_reinstall()
+        self.assertEquals(404, returned_response.status)
+        steps = [step['Step'] for step in returned_response.dict['Steps']]
+        self.assertEquals(['ForceOff', 'Pxe', 'On', 'Hdd'], steps)
+        mock_request.assert_called_with(
+            'https://10.42.34.79/Vms/set_boot_device_api/boot_devices:hd/vm_name:ms-1.xml')
+        self.assertFalse(mock_sleep.called)
+
+    @patch('redfishtool.RedfishClient.pxe_reinstall')
+    def test_post_pxe_reinstall(self, mock_method):
+        resp = namedtuple('resp', 'status')
+        mock_method.return_value = resp(status=200)
+        self.adapter = RedfishClient('15.16.17.43', 'user', 'pass', REDFISH_V1)
+        returned_response = self.adapter.post(
+            "/redfish/v1/Systems/1/Actions/Oem/RedfishCloud.PxeReinstall/", body={'BootWait': 10})
+        self.assertEquals(200, returned_response.status)
+        mock_method.assert_called_once_with(10)
+
+        for boot_wait in ['10', -1, None, True, float('nan')]:
+            returned_response = self.adapter.post(
+                "/redfish/v1/Systems/1/Actions/Oem/RedfishCloud.PxeReinstall/", body={'BootWait': boot_wait})
+            self.assertEquals(400, returned_response.status)
+        self.assertEquals(1, mock_method.call_count)
+
+    def test_node_mapper(self):
+        mapper = redfishtool.NodeMapper(redfishtool.NodeMapper.compile({
+            'exact': {'10.0.0.5': 'ms-1'},
+            'octets': [{'subnet': '10.42.34.0/24', 'names': {'43': 'sc-1'}},
+                       {'subnet': '10.42.0.0/16', 'names': {'43': 'sc-2'}}],
+            'ranges': [{'cidr': '10.50.0.0/24', 'template': 'pl-{offset}'}]}))
+        self.assertEquals('ms-1', mapper.lookup('10.0.0.5'))
+        self.assertEquals('sc-1', mapper.lookup('10.42.34.43'))
+        self.assertEquals('sc-2', mapper.lookup('10.42.35.43'))
+        self.assertEquals(None, mapper.lookup('10.43.34.43'))
+        self.assertEquals('pl-7', mapper.lookup('10.50.0.7'))
+        self.assertEquals(None, mapper.lookup('10.50.1.7'))
+
+        self.assertRaises(ValueError, redfishtool.NodeMapper.compile,
+                          {'ranges': [{'cidr': '10.0.0.0/24', 'template': 'a'},
+                                      {'cidr': '10.0.0.128/25', 'template': 'b'}]})
+        self.assertRaises(ValueError, redfishtool.NodeMapper.compile, {'exact': {'foo': 'ms-1'}})
+
+    def test_node_mapper_load(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            node_map = os.path.join(tmpdir, 'node_map.json')
+            with open(node_map, 'w') as _f:
+                _f.write('{"octets": [{"subnet": "15.16.17.0/24", "names": {"18": "pl-5"}}]}')
+            env = {'REDFISH_CLOUD_NODE_MAP': node_map, 'REDFISH_CLOUD_STATE_DIR': tmpdir}
+            with patch.dict(os.environ, env):
+                self.adapter = RedfishClient('15.16.17.18', 'user', 'pass', REDFISH_V1)
+                self.assertEquals('pl-5', self.adapter.vmname)
+                self.assertRaises(ValueError, RedfishClient, '15.16.17.43')
+                cached = redfishtool.load_state('node_map.compiled.json')
+                self.assertEquals(node_map, cached['key'][0])
+
+                del redfishtool._NODE_MAPPER[:]
+                with patch('redfishtool.NodeMapper.compile') as mock_compile:
+                    self.assertEquals('pl-5', RedfishClient.litp_vm_name('15.16.17.18'))
+                    self.assertFalse(mock_compile.called)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @patch('redfishtool.threading.Thread')
+    def test_log_pipeline(self, mock_thread):
+        log_file = os.path.join(self.state_dir, 'redfish.log')
+        pipeline = redfishtool.LogPipeline(path=log_file, maxsize=2)
+        unformatted = MagicMock()
+        pipeline.log(redfishtool.DEBUG, 'Debug {0}', (unformatted,))
+        for index in range(3):
+            pipeline.log(redfishtool.INFO, 'Message {0}', (index,))
+        self.assertEquals(1, pipeline.dropped)
+        mock_thread.return_value.start.assert_called_once_with()
+
+        pipeline.flush()
+        with open(log_file) as _f:
+            lines = [line.split(' ', 2)[2] for line in _f.read().splitlines()]
+        self.assertEquals(['redfish.cloud : 1 log messages dropped',
+                           'redfish.cloud : Message 0',
+                           'redfish.cloud : Message 1'], lines)
+        self.assertFalse(unformatted.__str__.called)
+
+    @patch('redfishtool.threading.Thread')
+    def test_log_pipeline_fork(self, mock_thread):
+        log_file = os.path.join(self.state_dir, 'redfish.log')
+        pipeline = redfishtool.LogPipeline(path=log_file)
+        pipeline.log(redfishtool.INFO, 'Parent', ())
+        with patch('redfishtool.os.getpid', return_value=os.getpid() + 1):
+            pipeline.log(redfishtool.INFO, 'Child', ())
+            pipeline.log(redfishtool.INFO, 'Child again', ())
+            self.assertEquals(2, mock_thread.return_value.start.call_count)
+            pipeline.flush()
+        with open(log_file) as _f:
+            lines = [line.split(' ', 2)[2] for line in _f.read().splitlines()]
+        self.assertEquals(['redfish.cloud : Child', 'redfish.cloud : Child again'], lines)
+
+    def test_log_pipeline_bad_message(self):
+        log_file = os.path.join(self.state_dir, 'redfish.log')
+        pipeline = redfishtool.LogPipeline(path=log_file)
+        pipeline.log(redfishtool.INFO, 'Message {0} {1}', (1,))
+        pipeline.log(redfishtool.INFO, 'Message {0}', (2,))
+        for _ in range(500):
+            if os.path.exists(log_file):
+                with open(log_file) as _f:
+                    lines = [line.split(' ', 2)[2] for line in _f.read().splitlines()]
+                if len(lines) == 2:
+                    break
+            time.sleep(0.01)
+        self.assertEquals(['redfish.cloud : Message {0} {1}',
+                           'redfish.cloud : Message 2'], lines)
+
+    @patch('redfishtool.urllib2.Request')
+    @patch('redfishtool.urllib2.urlopen')
+    def test_job_queue(self, mock_urlopen, mock_request):
+        resp = namedtuple('resp', 'code')
+        mock_urlopen.return_value = resp(code=200)
+        self.adapter = RedfishClient('1.1.1.42', 'user', 'pass', REDFISH_V1)
+        queue = redfishtool.JobQueue(boot_wait=0)
+
+        poweron = queue.submit(self.adapter, 'poweron')
+        poweroff = queue.submit(self.adapter, 'poweroff')
+        self.assertTrue(queue.run_next())
+        mock_request.assert_called_once_with('https://10.42.34.79/Vms/poweron_api/vm_name:ms-1.xml')
+        self.assertEquals('pending', queue.get(poweron)['state'])
+        self.assertEquals(1, queue.get(poweron)['step'])
+
+        self.assertTrue(queue.run_next())
+        mock_request.assert_called_with(
+            'https://10.42.34.79/Vms/set_boot_device_api/boot_devices:hd/vm_name:ms-1.xml')
+        self.assertEquals('done', queue.wait(poweron)['state'])
+        self.assertTrue(queue.run_next())
+        mock_request.assert_called_with('https://10.42.34.79/Vms/poweroff_api/vm_name:ms-1.xml')
+        self.assertFalse(queue.run_next())
+        self.assertEquals(200, queue.get(poweroff)['status'])
+
+        self.assertRaises(ValueError, queue.submit, self.adapter, 'reboot')
+
+    @patch('redfishtool.urllib2.urlopen')
+    def test_job_queue_resume(self, mock_urlopen):
+        resp = namedtuple('resp', 'code')
+        mock_urlopen.return_value = resp(code=404)
+        self.adapter = RedfishClient('1.1.1.42', 'user', 'pass', REDFISH_V1)
+        queue = redfishtool.JobQueue()
+        job_id = queue.submit(self.adapter, 'bootdev_hd')
+        with patch('redfishtool.os.getpid') as mock_getpid:
+            mock_getpid.return_value = 2 ** 22 + 1
+            queue._claim()
+        self.assertEquals('running', queue.get(job_id)['state'])
+
+        with patch('redfishtool.os.getpid') as mock_getpid:
+            mock_getpid.return_value = 2 ** 22 + 1
+            later_id = queue.submit(self.adapter, 'bootdev_hd', delay=3600)
+
+        queue = redfishtool.JobQueue()
+        job = queue.get(job_id)
+        self.assertEquals('failed', job['state'])
+        self.assertEquals(404, job['status'])
+        self.assertEquals('pending', queue.get(later_id)['state'])
+        self.assertEquals(1, mock_urlopen.call_count)
+
+    @patch('redfishtool.urllib2.Request')
+    @patch('redfishtool.urllib2.urlopen')
+    def test_job_queue_superseded(self, mock_urlopen, mock_request):
+        resp = namedtuple('resp', 'code')
+        mock_urlopen.return_value = resp(code=200)
+        self.adapter = RedfishClient('1.1.1.42', 'user', 'pass', REDFISH_V1)
+        queue = redfishtool.JobQueue(boot_wait=0)
+        stale = queue.submit(self.adapter, 'bootdev_hd', delay=3600)
+        other = queue.submit(RedfishClient('1.1.1.43', 'user', 'pass', REDFISH_V1), 'bootdev_hd', delay=3600)
+
+        self.assertEquals(200, self.adapter.set_bootdev_pxe().status)
+        self.assertEquals('superseded', queue.get(stale)['state'])
+        self.assertEquals('pending', queue.get(other)['state'])
+        mock_request.assert_called_once_with(
+            'https://10.42.34.79/Vms/set_boot_device_api/boot_devices:net/vm_name:ms-1.xml')
+
+        job = queue.submit(self.adapter, 'pxe_reinstall')
+        self.assertEquals('done', queue.run_now(job)['state'])
+        self.assertEquals('pending', queue.get(other)['state'])
+
+    @patch('redfishtool.POWERON_BOOT_WAIT', 0)
+    @patch('redfishtool.urllib2.Request')
+    @patch('redfishtool.urllib2.urlopen')
+    def test_set_poweron_resumed(self, mock_urlopen, mock_request):
+        resp = namedtuple('resp', 'code')
+        mock_urlopen.return_value = resp(code=200)
+        self.adapter = RedfishClient('1.1.1.42', 'user', 'pass', REDFISH_V1)
+
+        with patch('redfishtool.time.sleep', side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, self.adapter.set_poweron)
+        mock_request.assert_called_once_with('https://10.42.34.79/Vms/poweron_api/vm_name:ms-1.xml')
+
+        self.assertEquals(0, redfishtool.main(['worker']))
+        mock_request.assert_called_with(
+            'https://10.42.34.79/Vms/set_boot_device_api/boot_devices:hd/vm_name:ms-1.xml')
+        self.assertEquals(2, mock_request.call_count)
+
+    def test_job_queue_worker_error(self):
+        queue = redfishtool.JobQueue(poll_interval=0.01)
+        calls = []
+
+        def run_next():
+            calls.append(None)
+            if len(calls) == 1:
+                raise redfishtool.sqlite3.OperationalError('database is locked')
+            return False
+
+        with patch.object(queue, 'run_next', side_effect=run_next):
+            queue.start(workers=1)
+            for _ in range(500):
+                if len(calls) > 1:
+                    break
+                time.sleep(0.01)
+            queue.stop()
+        self.assertTrue(len(calls) > 1)
+
+    @patch('redfishtool.RedfishClient.set_poweroff')
+    def test_profiled_operation(self, mock_method):
+        resp = namedtuple('resp', 'status')
+        mock_method.return_value = resp(status=200)
+        profile_dir = os.path.join(self.state_dir, 'profiles')
+        self.adapter = RedfishClient('15.16.17.43', 'user', 'pass', REDFISH_V1)
+        body = {"ResetType": "ForceOff"}
+
+        with patch('redfishtool.cProfile.Profile') as mock_profile:
+            self.adapter.post(RESET, body=body)
+            self.assertFalse(mock_profile.called)
+
+        os.makedirs(os.path.join(profile_dir, 'archive'))
+        with open(os.path.join(profile_dir, 'notes.txt'), 'w') as _f:
+            _f.write('kept')
+        redfishtool.PROFILER.enable(profile_dir)
+        try:
+            with patch.object(redfishtool.PROFILER, 'max_files', 2):
+                for _ in range(2):
+                    returned_response = self.adapter.post(RESET, body=body)
+        finally:
+            redfishtool.PROFILER.disable()
+            redfishtool.PROFILER.directory = None
+        self.assertEquals(200, returned_response.status)
+        profiles = sorted(os.listdir(profile_dir))
+        self.assertEquals(4, len(profiles))
+        self.assertTrue(profiles[0].endswith('-post.folded'))
+        self.assertTrue(profiles[1].endswith('-post.prof'))
+        self.assertEquals(['archive', 'notes.txt'], profiles[2:])
+
+    @patch('redfishtool.get_vapp_snapshot')
+    def test_profiled_operation_name(self, mock_snapshot):
+        profile_dir = os.path.join(self.state_dir, 'profiles')
+        redfishtool.PROFILER.enable(profile_dir)
+        try:
+            redfishtool.reconcile({})
+        finally:
+            redfishtool.PROFILER.disable()
+            redfishtool.PROFILER.directory = None
+        profiles = sorted(os.listdir(profile_dir))
+        self.assertTrue(profiles[0].endswith('-reconcile.folded'))
+        self.assertTrue(profiles[1].endswith('-reconcile.prof'))
+
+    def test_profiled_worker_threads(self):
+        profile_dir = os.path.join(self.state_dir, 'profiles')
+        clients = {'1.1.1.42': RedfishClient('1.1.1.42', 'user', 'pass', REDFISH_V1),
+                   '1.1.1.43': RedfishClient('1.1.1.43', 'user', 'pass', REDFISH_V1)}
+
+        def slow_power_off(client):
+            time.sleep(0.2)
+            return RedfishClient._create_spp_response(200, 'Off')
+
+        @redfishtool.profiled('concurrent')
+        def operation():
+            return redfishtool._run_concurrently(clients, slow_power_off)
+
+        redfishtool.PROFILER.enable(profile_dir)
+        try:
+            operation()
+        finally:
+            redfishtool.PROFILER.disable()
+            redfishtool.PROFILER.directory = None
+        folded = [name for name in os.listdir(profile_dir) if name.endswith('.folded')][0]
+        with open(os.path.join(profile_dir, folded)) as _f:
+            stacks = [line.rsplit(' ', 1)[0] for line in _f.read().splitlines()]
+        self.assertTrue([stack for stack in stacks if stack.startswith('MainThread;')])
+        self.assertTrue([stack for stack in stacks if 'slow_power_off' in stack and
+                         not stack.startswith('MainThread;')])
+
+        with patch.dict(os.environ, {'REDFISH_CLOUD_PROFILE_MAX_FILES': '5O'}):
+            profiler = redfishtool.OperationProfiler()
+        self.assertEquals(redfishtool.OperationProfiler.DEFAULT_MAX_FILES, profiler.max_files)
+
+    @patch('redfishtool.urllib2.urlopen')
+    def test_warmup(self, mock_urlopen):
+        mock_urlopen.side_effect = redfishtool.urllib2.URLError('Connection refused')
+
+        report = redfishtool.warmup()
+        self.assertEquals(['environment', 'node_map', 'pod_api'], [entry['Stage'] for entry in report])
+        self.assertEquals(False, report[0]['Result'])
+        self.assertEquals('15 rules', report[1]['Result'])
+        self.assertTrue('Error' in report[2])
+
+        with patch('redfishtool.warmup') as mock_warmup:
+            mock_warmup.return_value = report[:2]
+            self.assertEquals(0, redfishtool.main(['warmup']))
+            mock_warmup.return_value = report
+            self.assertEquals(1, redfishtool.main(['warmup']))
+
+    @patch('redfishtool.urllib2.urlopen')
+    def test_warmup_unexpected_error(self, mock_urlopen):
+        class BadStatusLine(Exception):
+            pass
+
+        mock_urlopen.side_effect = BadStatusLine('')
+        report = redfishtool.warmup()
+        self.assertEquals('pod_api', report[-1]['Stage'])
+        self.assertTrue('Error' in report[-1])